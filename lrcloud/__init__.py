@@ -1,2 +1,5 @@
 # -*- coding: utf-8 -*-
 
+from __future__ import absolute_import
+
+from .session import SyncSession, PullResult, PushResult, SyncStatus
@@ -5,167 +5,27 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+# NB: lrcloud is started many times a day from launchers and scripts thus
+#     modules only used by some of the commands are imported where needed
 import argparse
 import os
 import sys
-import shutil
-import subprocess
 import logging
-import distutils.dir_util
 from os.path import join, basename, dirname, isfile, abspath
-import traceback
-import tempfile
-import hashlib
-from functools import partial
 from datetime import datetime
-import re
-import pprint
 
 from . import util
-from .metafile import MetaFile
+from .util import lock_file, unlock_file, copy_smart_previews, hashsum
+from .metafile import MetaFile, DATETIME_FORMAT, ENCODINGS
+from .changeset import Node, ChangesetDAG, client_markers
+from .session import SyncSession
+from .stats import Stats, load_hook
 from . import config_parser
 
-DATETIME_FORMAT='%Y-%m-%d %H:%M:%S.%f'
-
-def lock_file(filename):
-    """Locks the file by writing a '.lock' file.
-       Returns True when the file is locked and
-       False when the file was locked already"""
-
-    lockfile = "%s.lock"%filename
-    if isfile(lockfile):
-        return False
-    else:
-        with open(lockfile, "w"):
-            pass
-    return True
-
-
-def unlock_file(filename):
-    """Unlocks the file by remove a '.lock' file.
-       Returns True when the file is unlocked and
-       False when the file was unlocked already"""
-
-    lockfile = "%s.lock"%filename
-    if isfile(lockfile):
-        os.remove(lockfile)
-        return True
-    else:
-        return False
-
-
-def copy_smart_previews(local_catalog, cloud_catalog, local2cloud=True):
-    """Copy Smart Previews from local to cloud or
-       vica versa when 'local2cloud==False'
-       NB: nothing happens if source dir doesn't exist"""
-
-    lcat_noext = local_catalog[0:local_catalog.rfind(".lrcat")]
-    ccat_noext = cloud_catalog[0:cloud_catalog.rfind(".lrcat")]
-    lsmart = join(dirname(local_catalog),"%s Smart Previews.lrdata"%basename(lcat_noext))
-    csmart = join(dirname(cloud_catalog),"%s Smart Previews.lrdata"%basename(ccat_noext))
-    if local2cloud and os.path.isdir(lsmart):
-        logging.info("Copy Smart Previews - local to cloud: %s => %s"%(lsmart, csmart))
-        distutils.dir_util.copy_tree(lsmart,csmart, update=1)
-    elif os.path.isdir(csmart):
-        logging.info("Copy Smart Previews - cloud to local: %s => %s"%(csmart, lsmart))
-        distutils.dir_util.copy_tree(csmart,lsmart, update=1)
-
-
-def hashsum(filename):
-    """Return a hash of the file From <http://stackoverflow.com/a/7829658>"""
-
-    with open(filename, mode='rb') as f:
-        d = hashlib.sha1()
-        for buf in iter(partial(f.read, 2**20), b''):
-            d.update(buf)
-    return d.hexdigest()
-
-
-class Node:
-    def __init__(self, mfile):
-        self.mfile = mfile
-        self.parents = []
-        self.children = []
-        self.hash = mfile['changeset']['hash'] # Shortcut
-    def __repr__(self):
-        parents = "["
-        for parent in self.parents:
-            parents += "%s, "%parent.hash
-        parents += "]"
-        children = "["
-        for child in self.children:
-            children += "%s, "%child.hash
-        children += "]"
-        return "{%s, parents: %s, children: %s}"%(self.hash, parents, children)
-
-class ChangesetDAG:
-
-    def _get_all_cloud_mfiles(self, cloud_catalog):
-        ret = ["%s.lrcloud"%cloud_catalog]
-        cloud_dir = dirname(cloud_catalog)
-        for f in os.listdir(cloud_dir):
-            f = abspath(join(cloud_dir, f))
-            if not isfile(f):
-                continue
-            # Note that we escape windows backslashes in the path
-            pattern = "%s_[0-9a-fA-F]+\.zip\.lrcloud"%cloud_catalog.replace('\\', '\\\\')
-            if re.search(pattern, f):
-                ret.append(f)
-        return ret
-
-    def __init__(self, cloud_catalog):
-        self.nodes = {}  # Hash to node instance
-        self.leafs = []  # Leaf nodes
-        self.root = None # The root node
-
-        # Instantiate all nodes
-        for mfile in self._get_all_cloud_mfiles(cloud_catalog):
-            mfile = MetaFile(mfile) # File path to class instance
-            chash = mfile['changeset']['hash']
-            assert (chash not in self.nodes)
-            self.nodes[chash] = Node(mfile)
-        # Assign parents
-        for node in self.nodes.values():
-            if not node.mfile['changeset']['is_base']:
-                node.parents.append(self.nodes[node.mfile['parent']['hash']])
-                assert len(node.parents) == 1
-        # Assign children
-        for node in self.nodes.values():
-            for parent in node.parents:
-                self.nodes[parent.hash].children.append(node)
-                assert len(self.nodes[parent.hash].children) == 1
-        # Find leaf nodes
-        for node in self.nodes.values():
-            if len(node.children) == 0:
-                self.leafs.append(node)
-        # Find the root node, which is the base changeset
-        for node in self.nodes.values():
-            if node.mfile['changeset']['is_base']:
-                assert self.root is None
-                self.root = node
-
-        assert len(self.leafs) <= 1
-        assert self.root is not None
-
-    def path(self, a_hash, b_hash):
-        """Return nodes in the path between 'a' and 'b' going from
-        parent to child NOT including 'a' """
-
-        def _path(a, b):
-            if a is b:
-                return [a]
-            else:
-                assert len(a.children) == 1
-                return [a] + _path(a.children[0], b)
-
-        a = self.nodes[a_hash]
-        b = self.nodes[b_hash]
-        return _path(a, b)[1:]
-
-
-def cmd_init_push_to_cloud(args):
+def cmd_init_push_to_cloud(args, stats=None):
     """Initiate the local catalog and push it the cloud"""
 
+    stats = stats if stats is not None else Stats()
     (lcat, ccat) = (args.local_catalog, args.cloud_catalog)
     logging.info("[init-push-to-cloud]: %s => %s"%(lcat, ccat))
 
@@ -181,33 +41,45 @@ def cmd_init_push_to_cloud(args):
         args.error("[init-push-to-cloud] The cloud meta-data already exist: %s"%cmeta)
 
     #Let's "lock" the local catalog
-    logging.info("Locking local catalog: %s"%(lcat))
-    if not lock_file(lcat):
-        raise RuntimeError("The catalog %s is locked!"%lcat)
+    with stats.phase("lock"):
+        logging.info("Locking local catalog: %s"%(lcat))
+        if not lock_file(lcat):
+            raise RuntimeError("The catalog %s is locked!"%lcat)
 
     #Copy catalog from local to cloud, which becomes the new "base" changeset
-    util.copy(lcat, ccat)
+    with stats.phase("compress") as phase:
+        util.copy(lcat, ccat)
+        phase.read(lcat)
+        phase.wrote(ccat)
+
+    with stats.phase("hash") as phase:
+        lhash = hashsum(lcat)
+        phase.read(lcat)
 
     # Write meta-data both to local and cloud
-    mfile = MetaFile(lmeta)
-    utcnow = datetime.utcnow().strftime(DATETIME_FORMAT)[:-4]
-    mfile['catalog']['hash'] = hashsum(lcat)
-    mfile['catalog']['modification_utc'] = utcnow
-    mfile['catalog']['filename'] = lcat
-    mfile['last_push']['filename'] = ccat
-    mfile['last_push']['hash'] = hashsum(lcat)
-    mfile['last_push']['modification_utc'] = utcnow
-    mfile.flush()
-    mfile = MetaFile(cmeta)
-    mfile['changeset']['is_base'] = True
-    mfile['changeset']['hash'] = hashsum(lcat)
-    mfile['changeset']['modification_utc'] = utcnow
-    mfile['changeset']['filename'] = basename(ccat)
-    mfile.flush()
+    with stats.phase("metadata") as phase:
+        mfile = MetaFile(lmeta, args.metafile_encoding)
+        utcnow = datetime.utcnow().strftime(DATETIME_FORMAT)[:-4]
+        mfile['catalog']['hash'] = lhash
+        mfile['catalog'].update(util.catalog_state(lcat))
+        mfile['catalog']['modification_utc'] = utcnow
+        mfile['catalog']['filename'] = lcat
+        mfile['last_push']['filename'] = ccat
+        mfile['last_push']['hash'] = lhash
+        mfile['last_push']['modification_utc'] = utcnow
+        mfile.flush()
+        mfile = MetaFile(cmeta, args.metafile_encoding)
+        mfile['changeset']['is_base'] = True
+        mfile['changeset']['hash'] = lhash
+        mfile['changeset']['modification_utc'] = utcnow
+        mfile['changeset']['filename'] = basename(ccat)
+        mfile.flush()
+        phase.wrote(lmeta, cmeta)
 
     #Let's copy Smart Previews
     if not args.no_smart_previews:
-        copy_smart_previews(lcat, ccat, local2cloud=True)
+        with stats.phase("smart_previews") as phase:
+            phase.bytes_written += copy_smart_previews(lcat, ccat, local2cloud=True)
 
     #Finally,let's unlock the catalog files
     logging.info("Unlocking local catalog: %s"%(lcat))
@@ -216,9 +88,10 @@ def cmd_init_push_to_cloud(args):
     logging.info("[init-push-to-cloud]: Success!")
 
 
-def cmd_init_pull_from_cloud(args):
+def cmd_init_pull_from_cloud(args, stats=None):
     """Initiate the local catalog by downloading the cloud catalog"""
 
+    stats = stats if stats is not None else Stats()
     (lcat, ccat) = (args.local_catalog, args.cloud_catalog)
     logging.info("[init-pull-from-cloud]: %s => %s"%(ccat, lcat))
 
@@ -234,32 +107,47 @@ def cmd_init_pull_from_cloud(args):
         args.error("[init-pull-from-cloud] The cloud meta-data does not exist: %s"%cmeta)
 
     #Let's "lock" the local catalog
-    logging.info("Locking local catalog: %s"%(lcat))
-    if not lock_file(lcat):
-        raise RuntimeError("The catalog %s is locked!"%lcat)
+    with stats.phase("lock"):
+        logging.info("Locking local catalog: %s"%(lcat))
+        if not lock_file(lcat):
+            raise RuntimeError("The catalog %s is locked!"%lcat)
 
     #Copy base from cloud to local
-    util.copy(ccat, lcat)
+    with stats.phase("compress") as phase:
+        util.copy(ccat, lcat)
+        phase.read(ccat)
+        phase.wrote(lcat)
 
     #Apply changesets
-    cloudDAG = ChangesetDAG(ccat)
-    path = cloudDAG.path(cloudDAG.root.hash, cloudDAG.leafs[0].hash)
-    util.apply_changesets(args, path, lcat)
+    with stats.phase("dag") as phase:
+        cloudDAG = ChangesetDAG(ccat)
+        phase.read(*["%s.lrcloud"%n.filename for n in cloudDAG.nodes.values()])
+        phase.info['new_changesets'] = len(cloudDAG.nodes)
+    path = cloudDAG.path(cloudDAG.root.hash, cloudDAG.leaf.hash)
+    util.apply_changesets(args, path, lcat, stats)
+
+    with stats.phase("hash") as phase:
+        lhash = hashsum(lcat)
+        phase.read(lcat)
 
     # Write meta-data both to local and cloud
-    mfile = MetaFile(lmeta)
-    utcnow = datetime.utcnow().strftime(DATETIME_FORMAT)[:-4]
-    mfile['catalog']['hash'] = hashsum(lcat)
-    mfile['catalog']['modification_utc'] = utcnow
-    mfile['catalog']['filename'] = lcat
-    mfile['last_push']['filename'] = cloudDAG.leafs[0].mfile['changeset']['filename']
-    mfile['last_push']['hash'] = cloudDAG.leafs[0].mfile['changeset']['hash']
-    mfile['last_push']['modification_utc'] = cloudDAG.leafs[0].mfile['changeset']['modification_utc']
-    mfile.flush()
+    with stats.phase("metadata") as phase:
+        mfile = MetaFile(lmeta, args.metafile_encoding)
+        utcnow = datetime.utcnow().strftime(DATETIME_FORMAT)[:-4]
+        mfile['catalog']['hash'] = lhash
+        mfile['catalog'].update(util.catalog_state(lcat))
+        mfile['catalog']['modification_utc'] = utcnow
+        mfile['catalog']['filename'] = lcat
+        mfile['last_push']['filename'] = cloudDAG.leaf.filename
+        mfile['last_push']['hash'] = cloudDAG.leaf.hash
+        mfile['last_push']['modification_utc'] = cloudDAG.leaf.modification_utc
+        mfile.flush()
+        phase.wrote(lmeta)
 
     #Let's copy Smart Previews
     if not args.no_smart_previews:
-        copy_smart_previews(lcat, ccat, local2cloud=False)
+        with stats.phase("smart_previews") as phase:
+            phase.bytes_read += copy_smart_previews(lcat, ccat, local2cloud=False)
 
     #Finally, let's unlock the catalog files
     logging.info("Unlocking local catalog: %s"%(lcat))
@@ -268,7 +156,7 @@ def cmd_init_pull_from_cloud(args):
     logging.info("[init-pull-from-cloud]: Success!")
 
 
-def cmd_normal(args):
+def cmd_normal(args, stats=None):
     """Normal procedure:
         * Pull from cloud (if necessary)
         * Run Lightroom
@@ -277,43 +165,14 @@ def cmd_normal(args):
     logging.info("cmd_normal")
 
     (lcat, ccat) = (args.local_catalog, args.cloud_catalog)
-    (lmeta, cmeta) = ("%s.lrcloud"%lcat, "%s.lrcloud"%ccat)
 
     if not isfile(lcat):
         args.error("The local catalog does not exist: %s"%lcat)
     if not isfile(ccat):
         args.error("The cloud catalog does not exist: %s"%ccat)
 
-    #Let's "lock" the local catalog
-    logging.info("Locking local catalog: %s"%(lcat))
-    if not lock_file(lcat):
-        raise RuntimeError("The catalog %s is locked!"%lcat)
-
-    #Backup the local catalog (overwriting old backup)
-    logging.info("Removed old backup: %s.backup"%lcat)
-    util.remove("%s.backup"%lcat)
-    util.copy(lcat, "%s.backup"%lcat)
-
-    lmfile = MetaFile(lmeta)
-    cmfile = MetaFile(cmeta)
-
-    #Apply changesets
-    cloudDAG = ChangesetDAG(ccat)
-    path = cloudDAG.path(lmfile['last_push']['hash'], cloudDAG.leafs[0].hash)
-    util.apply_changesets(args, path, lcat)
-
-    #Let's copy Smart Previews
-    if not args.no_smart_previews:
-        copy_smart_previews(lcat, ccat, local2cloud=False)
-
-    #Backup the local catalog (overwriting old backup)
-    logging.info("Removed old backup: %s.backup"%lcat)
-    util.remove("%s.backup"%lcat)
-    util.copy(lcat, "%s.backup"%lcat)
-
-    #Let's unlock the local catalog so that Lightroom can read it
-    logging.info("Unlocking local catalog: %s"%(lcat))
-    unlock_file(lcat)
+    session = SyncSession.from_args(args, stats)
+    session.pull(reset=args.reset_to_cloud)
 
     #Now we can start Lightroom
     if args.lightroom_exec_debug:
@@ -321,52 +180,274 @@ def cmd_normal(args):
         with open(lcat, "a") as f:
             f.write("%s\n"%args.lightroom_exec_debug)
     elif args.lightroom_exec:
+        import subprocess
         logging.info("Starting Lightroom: %s %s"%(args.lightroom_exec, lcat))
-        subprocess.call([args.lightroom_exec, lcat])
+        with session.stats.phase("lightroom"):
+            subprocess.call([args.lightroom_exec, lcat])
+
+    session.push()
+
+
+def verify_changesets(args, cloud_catalog, replay=False, jobs=None):
+    """Return a list of problems found in the changesets of 'cloud_catalog'.
+
+    The hash of every changeset is checked in parallel using 'jobs' threads
+    and the parent links are checked. When 'replay' is True, the changesets
+    leading to the leaf are also applied to a scratch copy of the base catalog
+    and the result is checked against the last catalog hash they recorded.
+    NB: forks are not problems since the next sync rebases them"""
+
+    from multiprocessing.pool import ThreadPool
+
+    problems = []
+
+    # Read all nodes and check the parent links
+    nodes = {}
+    for mfile in ChangesetDAG._get_all_cloud_mfiles(cloud_catalog):
+        try:
+            node = Node.from_metafile(mfile)
+        except Exception as e:
+            problems.append("Cannot read meta-data file %s: %s"%(mfile, e))
+            continue
+        if node.hash in nodes:
+            problems.append("Changeset %s is listed twice: %s and %s"
+                            %(node.hash, nodes[node.hash].filename, node.filename))
+        nodes[node.hash] = node
+    bases = [n for n in nodes.values() if n.is_base]
+    if len(bases) != 1:
+        problems.append("Expected one base changeset but found %d"%len(bases))
+    for node in nodes.values():
+        if not node.is_base and node.parent_hash not in nodes:
+            problems.append("The parent %s of changeset %s does not exist"
+                            %(node.parent_hash, node.hash))
+
+    # Check the hash of every changeset
+    def check(node):
+        if not util.fs.isfile(node.filename):
+            return "The changeset %s does not exist: %s"%(node.hash, node.filename)
+        try:
+            chash = util.content_hashsum(node.filename)
+        except Exception as e:
+            return "Cannot read changeset %s: %s"%(node.filename, e)
+        if chash != node.hash:
+            return "The changeset %s has the wrong hash %s: %s"%(node.hash, chash, node.filename)
+    pool = ThreadPool(jobs)
+    try:
+        for problem in pool.imap_unordered(check, nodes.values()):
+            if problem is not None:
+                problems.append(problem)
+    finally:
+        pool.close()
+        pool.join()
 
+    if not replay or len(problems) > 0:
+        return problems
+
+    # Replay all changesets into a scratch copy of the base
+    import shutil
+    import tempfile
     tmpdir = tempfile.mkdtemp()
-    tmp_patch = join(tmpdir, "tmp.patch")
-
-    diff_cmd = args.diff_cmd.replace("$in1", "%s.backup"%lcat)\
-                            .replace("$in2", lcat)\
-                            .replace("$out", tmp_patch)
-    logging.info("Diff: %s"%diff_cmd)
-    subprocess.call(diff_cmd, shell=True)
-
-    patch = "%s_%s.zip"%(ccat, hashsum(tmp_patch))
-    util.copy(tmp_patch, patch)
-
-    # Write cloud meta-data
-    mfile = MetaFile("%s.lrcloud"%patch)
-    utcnow = datetime.utcnow().strftime(DATETIME_FORMAT)[:-4]
-    mfile['changeset']['is_base'] = False
-    mfile['changeset']['hash'] = hashsum(tmp_patch)
-    mfile['changeset']['modification_utc'] = utcnow
-    mfile['changeset']['filename'] = basename(patch)
-    mfile['parent']['is_base']          = cloudDAG.leafs[0].mfile['changeset']['is_base']
-    mfile['parent']['hash']             = cloudDAG.leafs[0].mfile['changeset']['hash']
-    mfile['parent']['modification_utc'] = cloudDAG.leafs[0].mfile['changeset']['modification_utc']
-    mfile['parent']['filename']         = basename(cloudDAG.leafs[0].mfile['changeset']['filename'])
-    mfile.flush()
-
-    # Write local meta-data
-    mfile = MetaFile(lmeta)
-    mfile['catalog']['hash'] = hashsum(lcat)
-    mfile['catalog']['modification_utc'] = utcnow
-    mfile['last_push']['filename'] = patch
-    mfile['last_push']['hash'] = hashsum(tmp_patch)
-    mfile['last_push']['modification_utc'] = utcnow
-    mfile.flush()
-
-    shutil.rmtree(tmpdir, ignore_errors=True)
+    try:
+        cloudDAG = ChangesetDAG(cloud_catalog)
+        scratch = join(tmpdir, basename(args.local_catalog or "scratch.lrcat"))
+        path = cloudDAG.path(cloudDAG.root.hash, cloudDAG.leaf.hash)
+
+        def apply_path(begin, end):
+            """Apply the changesets path[begin:end] to the scratch catalog,
+               which is a new copy of the base when 'begin' is 0"""
+            if begin == 0:
+                util.remove(scratch)
+                util.copy(cloud_catalog, scratch)
+            util.apply_changesets(args, path[begin:end], scratch)
+
+        # The changesets record the hash of the catalog they result in when known
+        # by the machine that pushed them. Only the last recorded hash is checked
+        # and the first changeset that doesn't give its catalog is only searched
+        # for (by bisection) when that one differs
+        checked = [i for (i, node) in enumerate(path) if node.catalog_hash is not None]
+        if len(checked) > 0:
+            apply_path(0, checked[-1] + 1)
+            hashes = {checked[-1]: hashsum(scratch)}
+            if hashes[checked[-1]] != path[checked[-1]].catalog_hash:
+                (lo, hi) = (0, len(checked) - 1)
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    apply_path(0, checked[mid] + 1)
+                    hashes[checked[mid]] = hashsum(scratch)
+                    if hashes[checked[mid]] == path[checked[mid]].catalog_hash:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                node = path[checked[hi]]
+                problems.append("Replaying the changesets up to %s gives the catalog %s "
+                                "but it was pushed as %s"%(node.hash, hashes[checked[hi]],
+                                                           node.catalog_hash))
+                return problems
+            apply_path(checked[-1] + 1, len(path))
+        else:
+            apply_path(0, len(path))
+        expect = path[-1].catalog_hash if len(path) > 0 else None
+        # When the local catalog was the last to push, we know the hash of the leaf
+        if expect is None and args.local_catalog is not None and \
+           isfile("%s.lrcloud"%args.local_catalog):
+            lmfile = MetaFile("%s.lrcloud"%args.local_catalog)
+            if lmfile['last_push'].get('hash') == cloudDAG.leaf.hash:
+                expect = lmfile['catalog'].get('hash')
+                chash = hashsum(scratch)
+                if chash != expect:
+                    problems.append("Replaying the changesets gives the catalog %s "
+                                    "but the last push was %s"%(chash, expect))
+    except Exception as e:
+        problems.append("Cannot replay the changesets: %s"%e)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return problems
 
-    #Let's copy Smart Previews
-    if not args.no_smart_previews:
-        copy_smart_previews(lcat, ccat, local2cloud=True)
 
-    #Finally, let's unlock the catalog files
-    logging.info("Unlocking local catalog: %s"%(lcat))
-    unlock_file(lcat)
+def cmd_verify(args):
+    """Verify the integrity of the cloud changesets"""
+
+    ccat = args.cloud_catalog
+    logging.info("[verify]: %s"%ccat)
+
+    if not isfile(ccat):
+        args.error("[verify] The cloud catalog does not exist: %s"%ccat)
+
+    jobs = int(args.jobs) if args.jobs is not None else None
+    problems = verify_changesets(args, ccat, args.verify_replay, jobs)
+    for problem in problems:
+        logging.error("[verify]: %s"%problem)
+    if len(problems) > 0:
+        raise RuntimeError("[verify] Found %d problem(s) in %s"%(len(problems), ccat))
+
+    logging.info("[verify]: Success!")
+
+
+# The default number of days unreachable objects are kept before --gc deletes them
+GC_GRACE_DAYS = 7
+
+# The categories of the objects collected by --gc
+GC_CATEGORIES = ['changesets', 'metafiles', 'smart_previews']
+
+def _tree_stat(path):
+    """Return the size and the newest mtime of the file or directory 'path'"""
+
+    if not util.fs.isdir(path):
+        st = util.fs.stat(path)
+        return (st.st_size, st.st_mtime)
+    (size, mtime) = (0, util.fs.stat(path).st_mtime)
+    for name in util.fs.listdir(path):
+        (s, m) = _tree_stat(join(path, name))
+        (size, mtime) = (size + s, max(mtime, m))
+    return (size, mtime)
+
+
+def collect_garbage(cloud_catalog, grace_days=GC_GRACE_DAYS, dry_run=False, now=None):
+    """Delete the objects in the cloud folder that no machine needs and that are
+    older than 'grace_days' (nothing is deleted when 'dry_run' is True).
+
+    Changesets are needed when they are on the branch of a live leaf or of the
+    last push recorded in a client marker (see SyncSession.client_marker). An
+    unneeded changeset is only deleted together with all of its descendants thus
+    the meta-files left always form a DAG. Zip files without a meta-file are left
+    overs of aborted pushes. Smart Previews are orphans when no file in the
+    folder, such as a Lightroom or cloud catalog, has a name starting like theirs.
+
+    Returns a dict of category (see GC_CATEGORIES) to a dict of the 'count'
+    and 'bytes' of the objects that are reclaimable now, and the 'pending_bytes'
+    of those that are still within the grace period"""
+
+    import re
+    import time
+
+    now = time.time() if now is None else now
+    grace = grace_days * 24 * 3600
+    cloud_dir = dirname(cloud_catalog) or os.curdir
+    dag = ChangesetDAG(cloud_catalog)
+
+    # The changesets needed by the live branches and the machines
+    heads = [n.hash for n in dag.live_leafs]
+    for marker in client_markers(cloud_catalog):
+        heads.append(MetaFile(marker)['client'].get('last_push'))
+    needed = set()
+    for chash in heads:
+        node = dag.nodes.get(chash)
+        while node is not None and node.hash not in needed:
+            needed.add(node.hash)
+            node = node.parent
+
+    # Candidates are (category, path, size, is old) and groups are deleted as a whole
+    def candidate(category, path):
+        (size, mtime) = _tree_stat(path)
+        return (category, path, size, now - mtime >= grace)
+
+    groups = []
+    def collect(node):
+        """Add the group of the unneeded 'node' and its descendants, which
+           is only deletable when all of them are old. Returns whether it is"""
+        group = []
+        for (category, path) in [("metafiles", "%s.lrcloud"%node.filename),
+                                 ("changesets", node.filename)]:
+            if util.fs.isfile(path):
+                group.append(candidate(category, path))
+        deletable = all(c[3] for c in group)
+        for child in node.children:
+            deletable = collect(child) and deletable
+        groups.append((deletable, group))
+        return deletable
+    for node in list(dag.nodes.values()):
+        if node.hash not in needed and (node.parent is None or node.parent.hash in needed) \
+           and not node.is_base:
+            collect(node)
+
+    listing = util.fs.listdir(cloud_dir)
+    names = set(listing)
+    pattern = re.compile(r"%s_[0-9a-fA-F]+\.zip$"%re.escape(basename(cloud_catalog)))
+    # Any file but the .lrdata dirs may be the catalog of Smart Previews
+    catalogs = [n for n in listing if not n.endswith(".lrdata")]
+    suffix = " Smart Previews.lrdata"
+    for name in listing:
+        path = join(cloud_dir, name)
+        if pattern.match(name) and "%s.lrcloud"%name not in names:
+            c = candidate("changesets", path)
+            groups.append((c[3], [c]))
+        elif name.endswith(suffix) and util.fs.isdir(path) and \
+             not any(c.startswith(name[:-len(suffix)]) for c in catalogs):
+            c = candidate("smart_previews", path)
+            groups.append((c[3], [c]))
+
+    report = dict((c, {'count': 0, 'bytes': 0, 'pending_bytes': 0}) for c in GC_CATEGORIES)
+    for (deletable, group) in groups:
+        for (category, path, size, _) in group:
+            if deletable:
+                report[category]['count'] += 1
+                report[category]['bytes'] += size
+                if not dry_run:
+                    logging.info("[gc]: Removing %s"%path)
+                    util.remove(path)
+            else:
+                report[category]['pending_bytes'] += size
+    return report
+
+
+def cmd_gc(args):
+    """Report and delete the objects in the cloud folder that no machine needs"""
+
+    ccat = args.cloud_catalog
+    logging.info("[gc]: %s"%ccat)
+
+    if not isfile(ccat):
+        args.error("[gc] The cloud catalog does not exist: %s"%ccat)
+
+    grace = float(args.gc_grace) if args.gc_grace is not None else GC_GRACE_DAYS
+    report = collect_garbage(ccat, grace, args.gc_dry_run)
+    verb = "Reclaimable" if args.gc_dry_run else "Reclaimed"
+    for category in GC_CATEGORIES:
+        r = report[category]
+        print("%s %s: %d bytes in %d object(s), %d bytes within the %g day grace period"
+              %(verb, category, r['bytes'], r['count'], r['pending_bytes'], grace))
+
+    logging.info("[gc]: Success!")
 
 
 def parse_arguments(argv=None):
@@ -395,6 +476,17 @@ def parse_arguments(argv=None):
         help='Download the cloud catalog and initiate a corresponding local catalog',
         action="store_true"
     )
+    cmd_group.add_argument(
+        '--verify',
+        help='Verify the hashes and parent links of all changesets in the cloud',
+        action="store_true"
+    )
+    cmd_group.add_argument(
+        '--gc',
+        help='Delete the changesets, meta-data and Smart Previews in the cloud '
+             'that no machine needs',
+        action="store_true"
+    )
     parser.add_argument(
         '--cloud-catalog',
         help='The cloud/shared catalog file e.g. located in Google Drive or Dropbox',
@@ -435,7 +527,8 @@ def parse_arguments(argv=None):
     parser.add_argument(
         '--diff-cmd',
         help="The command that given two files, $in1 and $in2, "
-             "produces a diff file $out",
+             "produces a diff file $out. When not given, the builtin "
+             "page-level diff is used, which makes concurrent pushes mergeable",
         type=str,
         #default="./jdiff -f $in1 $in2 $out"
         #default="bsdiff $in1 $in2 $out"
@@ -443,11 +536,60 @@ def parse_arguments(argv=None):
     parser.add_argument(
         '--patch-cmd',
         help="The command that given a file, $in1, and a path, "
-             "$patch, produces a file $out",
+             "$patch, produces a file $out. Page-level changesets are "
+             "always applied by the builtin patch",
         type=str,
         #default="./jptch $in1 $patch $out"
         #default="bspatch $in1 $out $patch"
     )
+    parser.add_argument(
+        '--reset-to-cloud',
+        help="Discard the local changesets that conflict with the cloud and "
+             "sync the local catalog to the cloud leaf",
+        action="store_true"
+    )
+    parser.add_argument(
+        '--verify-replay',
+        help="When verifying, also apply all changesets to a scratch copy "
+             "of the base catalog",
+        action="store_true"
+    )
+    parser.add_argument(
+        '--jobs',
+        help="The number of threads used when verifying, which is the "
+             "number of CPUs when not given",
+        type=int
+    )
+    parser.add_argument(
+        '--gc-dry-run',
+        help="When collecting garbage, only report what would be deleted",
+        action="store_true"
+    )
+    parser.add_argument(
+        '--gc-grace',
+        help="When collecting garbage, only delete objects older than this "
+             "number of days, which is %d when not given"%GC_GRACE_DAYS,
+        type=float
+    )
+    parser.add_argument(
+        '--stats',
+        help="Write the time and I/O of each phase of the run as JSON to this file",
+        type=str
+    )
+    parser.add_argument(
+        '--stats-hook',
+        help="A function, given as 'module:function', that is called with the "
+             "stats of each run e.g. to export them to a monitoring system",
+        type=str
+    )
+    parser.add_argument(
+        '--metafile-encoding',
+        help="The encoding of new meta-data (.lrcloud) files. 'json' is faster "
+             "to read but not understood by older versions of lrcloud. When not "
+             "given, the encoding of the existing file or 'ini' is used",
+        choices=ENCODINGS,
+        type=str
+    )
     args = parser.parse_args(args=argv)
     args.error = parser.error
 
@@ -460,7 +602,7 @@ def parse_arguments(argv=None):
     config_parser.read(args)
     (lcat, ccat) = (args.local_catalog, args.cloud_catalog)
 
-    if lcat is None:
+    if lcat is None and not (args.verify or args.gc):
         parser.error("No local catalog specified, use --local-catalog")
     if ccat is None:
         parser.error("No cloud catalog specified, use --cloud-catalog")
@@ -469,15 +611,29 @@ def parse_arguments(argv=None):
 
 def main(argv=None):
     args = parse_arguments(argv)
+    stats = Stats(load_hook(args.stats_hook) if args.stats_hook else None)
     try:
         if args.init_push_to_cloud:
-            cmd_init_push_to_cloud(args)
+            cmd_init_push_to_cloud(args, stats)
         elif args.init_pull_from_cloud:
-            cmd_init_pull_from_cloud(args)
+            cmd_init_pull_from_cloud(args, stats)
+        elif args.verify:
+            cmd_verify(args)
+        elif args.gc:
+            cmd_gc(args)
         else:
-            cmd_normal(args)
+            cmd_normal(args, stats)
     finally:
-        unlock_file(args.local_catalog)
+        if not (args.verify or args.gc):#They never lock the local catalog
+            unlock_file(args.local_catalog)
+        #The stats of a failed run are also reported, but a failure to
+        #report them must not mask the exception of the run itself
+        try:
+            if args.stats:
+                stats.dump(args.stats)
+            stats.publish()
+        except Exception:
+            logging.exception("Failed to report the stats")
 
     config_parser.write(args)
 
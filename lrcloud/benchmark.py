@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of lrcloud on synthetic Lightroom-like SQLite catalogs
+
+The benchmark generates a catalog of a given size, simulates editing
+sessions that touch a fraction of the rows and times the init-push,
+init-pull and normal commands for each combination of chain length, diff
+backend and compression of the cloud catalog. The results are written
+as JSON thus runs of different versions can be compared:
+
+    $ python -m lrcloud.benchmark --size 100M --chain-lengths 1,10 --output before.json
+
+NB: the time of the normal command includes the editing session, which
+is run by lrcloud in place of Lightroom.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import platform
+from os.path import join, dirname, abspath
+
+from . import __main__ as lrcloud
+
+# The Python used to run the "copy" backend and the Lightroom stand-in
+PYTHON = '"%s"'%sys.executable
+
+# Diff backends: name to (diff command, patch command) where None is the builtin
+COPY_CMD = '%s -c "import shutil,sys; shutil.copyfile(sys.argv[2], sys.argv[3])"'%PYTHON
+BACKENDS = {
+    'pagediff': (None, None),
+    'copy': ("%s $in1 $in2 $out"%COPY_CMD, "%s $in1 $patch $out"%COPY_CMD),
+    'bsdiff': ("bsdiff $in1 $in2 $out", "bspatch $in1 $out $patch"),
+    'xdelta3': ("xdelta3 -e -f -s $in1 $in2 $out", "xdelta3 -d -f -s $in1 $patch $out"),
+}
+
+# Compression of the cloud catalog: name to extension of the cloud catalog
+COMPRESSIONS = {
+    'zip': ".zip",
+    'none': ".lrcat",
+}
+
+SCHEMA = """
+CREATE TABLE Adobe_images (
+    id_local INTEGER PRIMARY KEY, id_global TEXT, captureTime TEXT,
+    fileFormat TEXT, rating INTEGER, pick INTEGER, rootFile INTEGER);
+CREATE TABLE AgLibraryFile (
+    id_local INTEGER PRIMARY KEY, id_global TEXT, baseName TEXT,
+    extension TEXT, folder INTEGER);
+CREATE TABLE Adobe_imageDevelopSettings (
+    id_local INTEGER PRIMARY KEY, image INTEGER, digest TEXT, text TEXT);
+CREATE INDEX index_Adobe_images_rootFile ON Adobe_images(rootFile);
+CREATE INDEX index_Adobe_imageDevelopSettings_image ON Adobe_imageDevelopSettings(image);
+"""
+
+DEVELOP_KEYS = ["Exposure2012", "Contrast2012", "Highlights2012", "Shadows2012",
+                "Whites2012", "Blacks2012", "Clarity2012", "Vibrance", "Saturation",
+                "Temperature", "Tint", "Sharpness", "LuminanceSmoothing",
+                "ColorNoiseReduction", "VignetteAmount", "GrainAmount"]
+
+
+def parse_size(size):
+    """Return the number of bytes of a size such as '100M' or '5G'"""
+
+    size = str(size).strip().upper()
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def develop_settings(rand):
+    """Return a Lightroom-like develop setting text of roughly 1 KB"""
+
+    lines = ["s = { AutoLateralCA = 0,", "ProcessVersion = \"6.7\","]
+    for _ in range(3):
+        for key in DEVELOP_KEYS:
+            lines.append("%s = %.4f,"%(key, rand.uniform(-100, 100)))
+    lines.append("}")
+    return "\n".join(lines)
+
+
+def create_catalog(path, size, seed=0):
+    """Create a SQLite catalog at 'path' of at least 'size' bytes"""
+
+    import sqlite3
+
+    rand = random.Random(seed)
+    con = sqlite3.connect(path)
+    try:
+        con.executescript(SCHEMA)
+        image = 0
+        while os.path.getsize(path) < size:
+            rows = range(image + 1, image + 1001)
+            image += 1000
+            con.executemany("INSERT INTO AgLibraryFile VALUES (?, ?, ?, ?, ?)",
+                            [(i, "%032x"%rand.getrandbits(128), "IMG_%05d"%i, "CR2", i // 500)
+                             for i in rows])
+            con.executemany("INSERT INTO Adobe_images VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            [(i, "%032x"%rand.getrandbits(128), "2016-01-01T12:00:%02d"%(i % 60),
+                              "RAW", rand.randint(0, 5), 0, i) for i in rows])
+            con.executemany("INSERT INTO Adobe_imageDevelopSettings VALUES (?, ?, ?, ?)",
+                            [(i, i, "%032x"%rand.getrandbits(128), develop_settings(rand))
+                             for i in rows])
+            con.commit()
+    finally:
+        con.close()
+
+
+def edit_catalog(path, fraction, seed=None):
+    """Simulate an editing session that changes 'fraction' of the images"""
+
+    import sqlite3
+
+    rand = random.Random(seed)
+    con = sqlite3.connect(path)
+    try:
+        (count,) = con.execute("SELECT COUNT(*) FROM Adobe_images").fetchone()
+        images = rand.sample(range(1, count + 1), max(1, int(count * fraction)))
+        con.executemany("UPDATE Adobe_imageDevelopSettings SET digest=?, text=? WHERE image=?",
+                        [("%032x"%rand.getrandbits(128), develop_settings(rand), i)
+                         for i in images])
+        con.executemany("UPDATE Adobe_images SET rating=? WHERE id_local=?",
+                        [(rand.randint(0, 5), i) for i in images])
+        con.commit()
+    finally:
+        con.close()
+
+
+def write_editor(path, fraction):
+    """Write an executable that lrcloud can start instead of Lightroom, which
+       edits the catalog given as argument"""
+
+    with open(path, "w") as f:
+        f.write("#!%s\n"%sys.executable)
+        f.write("import sys\n")
+        f.write("sys.path.insert(0, %r)\n"%dirname(dirname(abspath(__file__))))
+        f.write("from lrcloud.benchmark import edit_catalog\n")
+        f.write("edit_catalog(sys.argv[1], %r)\n"%fraction)
+    os.chmod(path, 0o755)
+
+
+def dir_size(path):
+    """Return the total size of the files in 'path'"""
+
+    total = 0
+    for (root, _, files) in os.walk(path):
+        for name in files:
+            total += os.path.getsize(join(root, name))
+    return total
+
+
+def available_backends():
+    """Return the names of the backends that can run on this machine"""
+
+    try:
+        from shutil import which
+    except ImportError:
+        from distutils.spawn import find_executable as which
+    ret = []
+    for (name, (diff_cmd, _)) in sorted(BACKENDS.items()):
+        if diff_cmd is None or diff_cmd.startswith(PYTHON) or which(diff_cmd.split()[0]):
+            ret.append(name)
+    return ret
+
+
+def timed(argv):
+    """Run lrcloud with the arguments 'argv' and return the elapsed seconds"""
+
+    tic = time.time()
+    lrcloud.main(["--config-file=None"] + argv)
+    return time.time() - tic
+
+
+def run(size, edit_fraction, chain_lengths, backends, compressions, workdir=None):
+    """Run the benchmark and return the results as a dict. Every chain
+       length must be at least one changeset"""
+
+    if min(chain_lengths) < 1:
+        raise ValueError("The chain lengths must be at least 1: %s"%chain_lengths)
+    workdir = tempfile.mkdtemp(dir=workdir)
+    results = []
+    try:
+        template = join(workdir, "template.lrcat")
+        tic = time.time()
+        create_catalog(template, size)
+        catalog_bytes = os.path.getsize(template)
+        generate_seconds = time.time() - tic
+        editor = join(workdir, "lightroom.py")
+        write_editor(editor, edit_fraction)
+
+        for backend in backends:
+            (diff_cmd, patch_cmd) = BACKENDS[backend]
+            for compression in compressions:
+                scenario = join(workdir, "%s-%s"%(backend, compression))
+                os.makedirs(join(scenario, "cloud"))
+                ccat = join(scenario, "cloud", "cloud%s"%COMPRESSIONS[compression])
+                lcat = join(scenario, "local.lrcat")
+                shutil.copy(template, lcat)
+                common = ["--cloud-catalog", ccat, "--no-smart-previews"]
+                if diff_cmd is not None:
+                    common += ["--diff-cmd", diff_cmd, "--patch-cmd", patch_cmd]
+
+                def record(command, seconds, chain_length):
+                    results.append({
+                        'command': command,
+                        'backend': backend,
+                        'compression': compression,
+                        'chain_length': chain_length,
+                        'catalog_bytes': catalog_bytes,
+                        'edit_fraction': edit_fraction,
+                        'seconds': seconds,
+                        'cloud_bytes': dir_size(dirname(ccat)),
+                    })
+
+                seconds = timed(common + ["--init-push-to-cloud", "--local-catalog", lcat])
+                record("init_push_to_cloud", seconds, 0)
+
+                chain_length = 0
+                for length in sorted(set(chain_lengths)):
+                    # Every normal run adds a changeset edited by the Lightroom stand-in
+                    while chain_length < length:
+                        seconds = timed(common + ["--local-catalog", lcat,
+                                                  "--lightroom-exec", editor])
+                        chain_length += 1
+                    record("normal", seconds, chain_length)
+
+                    pulled = join(scenario, "pulled-%d.lrcat"%length)
+                    seconds = timed(common + ["--init-pull-from-cloud", "--local-catalog", pulled])
+                    record("init_pull_from_cloud", seconds, chain_length)
+                    lrcloud.util.remove(pulled)
+                shutil.rmtree(scenario, ignore_errors=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'generate_seconds': generate_seconds,
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                description='Benchmark lrcloud on synthetic SQLite catalogs',
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--size', help="Size of the generated catalog such as 100M or 5G",
+                        default="100M")
+    parser.add_argument('--edit-fraction', help="Fraction of the images changed by "
+                        "each editing session", type=float, default=0.01)
+    parser.add_argument('--chain-lengths', help="Comma separated list of the number of "
+                        "changesets to measure at", default="1,10")
+    parser.add_argument('--backends', help="Comma separated list of diff backends, "
+                        "which are the available ones of %s when not given"
+                        %", ".join(sorted(BACKENDS)))
+    parser.add_argument('--compressions', help="Comma separated list of cloud catalog "
+                        "compressions", default=",".join(sorted(COMPRESSIONS)))
+    parser.add_argument('--workdir', help="Directory for the temporary files")
+    parser.add_argument('--output', help="The JSON file to write instead of stdout")
+    args = parser.parse_args(argv)
+
+    backends = args.backends.split(",") if args.backends else available_backends()
+    for backend in backends:
+        if backend not in BACKENDS:
+            parser.error("Unknown backend: %s"%backend)
+    compressions = args.compressions.split(",")
+    for compression in compressions:
+        if compression not in COMPRESSIONS:
+            parser.error("Unknown compression: %s"%compression)
+    chain_lengths = [int(x) for x in args.chain_lengths.split(",")]
+    if min(chain_lengths) < 1:
+        parser.error("The chain lengths must be at least 1: %s"%args.chain_lengths)
+
+    report = run(parse_size(args.size), args.edit_fraction, chain_lengths,
+                 backends, compressions, args.workdir)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from os.path import join, basename, dirname
+
+from . import util
+from .metafile import MetaFile, parse_datetime
+
+
+class Node(object):
+    """A changeset in the DAG
+
+    Only the fields needed by the DAG are kept. The modification time
+    is kept as the string found in the meta-file and is first parsed
+    when 'modification_time' is read. A changeset that rebased another
+    branch onto its parent names the leaf of that branch in 'merges'. The
+    hash of the catalog a changeset results in is 'catalog_hash' when it
+    was known by the machine that pushed it."""
+
+    __slots__ = ('hash', 'filename', 'is_base', 'parent_hash',
+                 'modification_utc', 'merges', 'catalog_hash', 'parent', 'children')
+
+    def __init__(self, chash, filename, is_base, parent_hash=None,
+                 modification_utc=None, merges=None, catalog_hash=None):
+        self.hash = chash
+        self.filename = filename
+        self.is_base = is_base
+        self.parent_hash = parent_hash
+        self.modification_utc = modification_utc
+        self.merges = merges
+        self.catalog_hash = catalog_hash
+        self.parent = None
+        self.children = []
+
+    @classmethod
+    def from_metafile(cls, file_path):
+        """Return a node of the changeset described by the meta-file 'file_path'"""
+
+        mfile = MetaFile(file_path)
+        changeset = mfile['changeset']
+        is_base = changeset.get('is_base', False) is True
+        parent_hash = None if is_base else mfile['parent'].get('hash')
+        return cls(changeset['hash'], changeset['filename'], is_base,
+                   parent_hash, changeset.get('modification_utc'),
+                   changeset.get('merges'), changeset.get('catalog_hash'))
+
+    @property
+    def modification_time(self):
+        """The modification time as a datetime object (or None)"""
+        return parse_datetime(self.modification_utc)
+
+    def __repr__(self):
+        parent = self.parent.hash if self.parent is not None else None
+        children = "["
+        for child in self.children:
+            children += "%s, "%child.hash
+        children += "]"
+        return "{%s, parent: %s, children: %s}"%(self.hash, parent, children)
+
+
+def client_markers(cloud_catalog):
+    """Return the meta-files in which the machines syncing 'cloud_catalog'
+       record their last push (see SyncSession.client_marker)"""
+
+    import re
+    ret = []
+    cloud_dir = dirname(cloud_catalog)
+    pattern = re.compile(r"%s_client_[0-9a-fA-F]+\.lrcloud$"%re.escape(basename(cloud_catalog)))
+    for f in util.fs.listdir(cloud_dir if cloud_dir else os.curdir):
+        if pattern.match(f):
+            ret.append(join(cloud_dir, f))
+    return ret
+
+
+class ChangesetDAG:
+    """The changesets of a cloud catalog
+
+    The DAG is kept up to date with update(), which only reads the
+    meta-files that are new since the last update. Cloud folders may show
+    files in another order than they were written thus a changeset is
+    deferred until its parent has shown up.
+
+    Machines that push from the same parent make the DAG fork. A branch
+    stops being live when a changeset merges its leaf, i.e. when it has
+    been rebased onto another branch (see rebase.py). Everybody syncs to
+    'leaf', which is the live leaf of the branch that forked first."""
+
+    @staticmethod
+    def _get_all_cloud_mfiles(cloud_catalog):
+        import re
+        ret = ["%s.lrcloud"%cloud_catalog]
+        cloud_dir = dirname(cloud_catalog)
+        pattern = re.compile(r"%s_[0-9a-fA-F]+\.zip\.lrcloud$"%re.escape(basename(cloud_catalog)))
+        for f in util.fs.listdir(cloud_dir if cloud_dir else os.curdir):
+            if pattern.match(f):
+                f = join(cloud_dir, f)
+                if util.fs.isfile(f):
+                    ret.append(f)
+        return ret
+
+    def __init__(self, cloud_catalog):
+        self.cloud_catalog = cloud_catalog
+        self.nodes = {}  # Hash to node instance
+        self.leafs = []  # Leaf nodes
+        self.root = None # The root node
+        self.merged = set() # Hash of the leafs of the branches merged by a changeset
+        self._mfiles = set()  # Basename of the meta-files read
+        self._deferred = {}   # Basename of the meta-file to node not added yet
+        self._listing = None  # (mtime of the cloud dir, time of the listing)
+
+        self.update()
+        assert self.root is not None
+
+    def update(self):
+        """Read the meta-files that are new since the last update.
+           Returns the list of new nodes"""
+
+        import time
+
+        # The mtime of a directory changes when files are added thus we can skip
+        # the listing when it hasn't changed since a listing made well after it.
+        # NB: some file systems only have a mtime resolution of two seconds
+        cloud_dir = dirname(self.cloud_catalog) or os.curdir
+        mtime = util.fs.stat(cloud_dir).st_mtime
+        if self._listing is not None and self._listing[0] == mtime \
+           and self._listing[1] - mtime > 2 and len(self._deferred) == 0:
+            return []
+        now = time.time()
+
+        (deferred, self._deferred) = (self._deferred, {})
+        new = list(deferred.values())
+        for mfile in self._get_all_cloud_mfiles(self.cloud_catalog):
+            if basename(mfile) not in self._mfiles and \
+               basename(mfile) not in deferred:
+                new.append(Node.from_metafile(mfile))
+        new = self.add(new)
+        self._listing = (mtime, now)
+        return new
+
+    def add(self, nodes):
+        """Add the nodes in 'nodes' whose parent is in the DAG already or
+           in 'nodes'. The others are deferred to the next update().
+           Returns the list of added nodes"""
+
+        # Add the nodes in an order where the parent of each node is in the
+        # DAG before the node itself thus the DAG is complete at every step
+        pending = []
+        for node in nodes:
+            if node.hash not in self.nodes and node.hash not in [n.hash for n in pending]:
+                pending.append(node)
+        added = []
+        while len(pending) > 0:
+            ready = [n for n in pending if n.is_base or n.parent_hash in self.nodes]
+            if len(ready) == 0:
+                break
+            for node in ready:
+                self._add(node)
+                added.append(node)
+            pending = [n for n in pending if n.hash not in self.nodes]
+        for node in pending:
+            self._deferred[basename("%s.lrcloud"%node.filename)] = node
+        # Find leaf nodes
+        self.leafs = [n for n in self.leafs if len(n.children) == 0]
+        for node in added:
+            if len(node.children) == 0:
+                self.leafs.append(node)
+        return added
+
+    def _add(self, node):
+        if node.is_base:
+            # The root node is the base changeset
+            assert self.root is None
+            self.root = node
+        else:
+            node.parent = self.nodes[node.parent_hash]
+            node.parent.children.append(node)
+        self.nodes[node.hash] = node
+        self._mfiles.add(basename("%s.lrcloud"%node.filename))
+        if node.merges is not None:
+            self.merged.add(node.merges)
+
+    @property
+    def live_leafs(self):
+        """The leafs of the branches that haven't been merged"""
+        return [n for n in self.leafs if n.hash not in self.merged]
+
+    @property
+    def forked(self):
+        """Whether more than one branch is live"""
+        return len(self.live_leafs) > 1
+
+    @property
+    def leaf(self):
+        """The leaf to sync to, which is the live leaf that wins() over the others"""
+
+        leafs = self.live_leafs
+        if len(leafs) == 1:
+            return leafs[0]
+        winner = None
+        for node in sorted(leafs, key=lambda n: n.hash):
+            if winner is None or self.wins(node, winner):
+                winner = node
+        return winner
+
+    def ancestors(self, chash):
+        """Return the hash of 'chash' and all of its ancestors including
+           the leafs of the branches it merged and their ancestors"""
+
+        ret = set()
+        todo = [chash]
+        while len(todo) > 0:
+            node = self.nodes.get(todo.pop())
+            while node is not None and node.hash not in ret:
+                ret.add(node.hash)
+                if node.merges is not None:
+                    todo.append(node.merges)
+                node = node.parent
+        return ret
+
+    def is_ancestor(self, a_hash, b_hash):
+        """Return whether 'b' is 'a' or a descendant of 'a' going from parent
+           to child only, i.e. whether path(a, b) exists"""
+
+        a = self.nodes[a_hash]
+        node = self.nodes[b_hash]
+        while node is not None and node is not a:
+            node = node.parent
+        return node is a
+
+    def fork(self, a, b):
+        """Return the nodes of the branch of node 'a' that 'b' doesn't have
+           going from child to parent and the node where the branch starts"""
+
+        ancestors = self.ancestors(b.hash)
+        branch = []
+        node = a
+        while node.hash not in ancestors:
+            branch.append(node)
+            node = node.parent
+        return (branch, node)
+
+    def wins(self, a, b):
+        """Return whether the branch of node 'a' wins over the branch of node 'b',
+           which is when its first changeset is the oldest (or has the lowest hash)"""
+
+        (a_branch, _) = self.fork(a, b)
+        (b_branch, _) = self.fork(b, a)
+        if len(a_branch) == 0 or len(b_branch) == 0:
+            return len(b_branch) == 0
+        (a, b) = (a_branch[-1], b_branch[-1])
+        return (a.modification_utc or "", a.hash) < (b.modification_utc or "", b.hash)
+
+    def path(self, a_hash, b_hash):
+        """Return nodes in the path between 'a' and 'b' going from
+        parent to child NOT including 'a' (see is_ancestor())"""
+
+        a = self.nodes[a_hash]
+        ret = []
+        node = self.nodes[b_hash]
+        while node is not a:
+            ret.append(node)
+            node = node.parent
+            assert node is not None
+        ret.reverse()
+        return ret
@@ -14,6 +14,15 @@ from os.path import join, basename, dirname, isfile, abspath
 
 IGNORE_ARGS = ['init_push_to_cloud',
                'init_pull_from_cloud',
+               'verify',
+               'verify_replay',
+               'gc',
+               'gc_dry_run',
+               'gc_grace',
+               'jobs',
+               'reset_to_cloud',
+               'stats',
+               'stats_hook',
                'verbose',
                'config_file',
                'error',
@@ -42,9 +51,9 @@ def read(args):
 
 
 def write(args):
-    """Writing the configure file with the attributes in 'args'"""
+    """Writing the configure file with the attributes in 'args'.
+       Nothing is written when the file is up to date"""
 
-    logging.info("Writing configure file: %s"%args.config_file)
     if args.config_file is None:
         return
 
@@ -58,5 +67,18 @@ def write(args):
         if value is not None:
             config.set('lrcloud', p, str(value))
 
+    if sys.version_info >= (3,):
+        from io import StringIO
+    else:
+        from StringIO import StringIO
+    content = StringIO()
+    config.write(content)
+    content = content.getvalue()
+    if isfile(args.config_file):
+        with open(args.config_file, 'r') as f:
+            if f.read() == content:
+                return
+
+    logging.info("Writing configure file: %s"%args.config_file)
     with open(args.config_file, 'w') as f:
-        config.write(f)
+        f.write(content)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""A stand-in for a cloud folder (Dropbox, Google Drive, a NAS, ...) used to
+reproduce performance problems and failures without the actual service.
+
+FakeCloudFS replaces util.fs while used as a context manager. Operations on
+paths inside the cloud directory are counted and can be made slow, appear
+late or fail half way:
+
+    with FakeCloudFS(cloud_dir, latency=0.05, bandwidth=2**20) as cloud:
+        session.pull()
+    print(cloud.calls, cloud.bytes_read)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import errno
+import time
+import random
+import fnmatch
+from os.path import join, basename, realpath
+
+from . import util
+
+
+class InjectedFailure(IOError):
+    """A failure injected by FakeCloudFS"""
+    pass
+
+
+class FakeCloudFS(util.LocalFS):
+    """A local directory that behaves like a slow and unreliable cloud folder
+
+    latency           Seconds added to every operation in the cloud
+    bandwidth         Bytes per second when reading or writing file content
+    visibility_delay  Seconds before a written file shows up for everybody,
+                      or a list of (pattern, seconds) where the first
+                      pattern matching the file name gives its delay, e.g.
+                      [("*.zip", 60)] makes meta-files show up before
+                      their changesets
+    visibility_jitter Up to this many random seconds are added to the
+                      delay of every written file, thus files may show up
+                      in another order than they were written
+    failure_rate      Probability that a write fails half way
+    seed              Seed of the random jitter and failures
+    clock, sleep      Functions replacing time.time() and time.sleep(), e.g.
+                      a simulated clock that makes the tests fast
+    """
+
+    def __init__(self, cloud_dir, latency=0.0, bandwidth=None, visibility_delay=0.0,
+                 visibility_jitter=0.0, failure_rate=0.0, seed=None, clock=None,
+                 sleep=None):
+        self.cloud_dir = realpath(cloud_dir)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.visibility_delay = visibility_delay
+        self.visibility_jitter = visibility_jitter
+        self.failure_rate = failure_rate
+        self.clock = clock or time.time
+        self.sleep = sleep or time.sleep
+        self.calls = {}          # Operation name to number of calls in the cloud
+        self.bytes_read = 0      # Bytes read from the cloud
+        self.bytes_written = 0   # Bytes written to the cloud
+        self._visible_at = {}    # Real path to the time it shows up
+        self._forced_failures = 0
+        self._random = random.Random(seed)
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = util.fs
+        util.fs = self
+        return self
+
+    def __exit__(self, *exc_info):
+        util.fs = self._previous
+        self._previous = None
+
+    def fail_next_writes(self, count=1):
+        """Make the next 'count' writes to the cloud fail half way"""
+        self._forced_failures += count
+
+    def in_cloud(self, path):
+        path = realpath(path)
+        return path == self.cloud_dir or path.startswith(self.cloud_dir + os.sep)
+
+    def _operation(self, name, path):
+        """Count and delay the operation when 'path' is in the cloud.
+           Returns whether 'path' is in the cloud"""
+        if not self.in_cloud(path):
+            return False
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            self.sleep(self.latency)
+        return True
+
+    def _transfer(self, nbytes, write):
+        if write:
+            self.bytes_written += nbytes
+        else:
+            self.bytes_read += nbytes
+        if self.bandwidth:
+            self.sleep(nbytes / float(self.bandwidth))
+
+    def _delay(self, path):
+        """Return the seconds before the file 'path' written now shows up"""
+        delay = self.visibility_delay
+        if isinstance(delay, (list, tuple)):
+            name = basename(path)
+            delay = next((d for (pattern, d) in delay if fnmatch.fnmatch(name, pattern)), 0.0)
+        if self.visibility_jitter:
+            delay += self._random.uniform(0, self.visibility_jitter)
+        return delay
+
+    def _visible(self, path):
+        visible_at = self._visible_at.get(realpath(path))
+        return visible_at is None or self.clock() >= visible_at
+
+    def _mark_written(self, path):
+        self._visible_at[realpath(path)] = self.clock() + self._delay(path)
+
+    def _failing_write(self):
+        if self._forced_failures > 0:
+            self._forced_failures -= 1
+            return True
+        return self.failure_rate > 0 and self._random.random() < self.failure_rate
+
+    def _not_visible(self, path):
+        return OSError(errno.ENOENT, "No such file (not visible yet)", path)
+
+    def listdir(self, path):
+        names = util.LocalFS.listdir(self, path)
+        if self._operation("listdir", path):
+            names = [n for n in names if self._visible(join(path, n))]
+        return names
+
+    def isfile(self, path):
+        if self._operation("isfile", path) and not self._visible(path):
+            return False
+        return util.LocalFS.isfile(self, path)
+
+    def isdir(self, path):
+        if self._operation("isdir", path) and not self._visible(path):
+            return False
+        return util.LocalFS.isdir(self, path)
+
+    def stat(self, path):
+        if self._operation("stat", path) and not self._visible(path):
+            raise self._not_visible(path)
+        return util.LocalFS.stat(self, path)
+
+    def open(self, path, mode='r'):
+        if not self._operation("open", path):
+            return util.LocalFS.open(self, path, mode)
+        write = 'w' in mode or 'a' in mode
+        if not write and not self._visible(path):
+            raise self._not_visible(path)
+        fail = write and self._failing_write()
+        return _CloudFile(self, util.LocalFS.open(self, path, mode), path, write, fail)
+
+    def copy(self, src, dst):
+        (csrc, cdst) = (self.in_cloud(src), self.in_cloud(dst))
+        if not csrc and not cdst:
+            return util.LocalFS.copy(self, src, dst)
+        self._operation("copy", src if csrc else dst)
+        if csrc and not self._visible(src):
+            raise self._not_visible(src)
+        size = os.path.getsize(src)
+        self._transfer(size, write=cdst)
+        if cdst and self._failing_write():
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                d.write(s.read(size // 2))
+            self._mark_written(dst)
+            raise InjectedFailure(errno.EIO, "Injected partial write", dst)
+        util.LocalFS.copy(self, src, dst)
+        if cdst:
+            self._mark_written(dst)
+
+    def makedirs(self, path):
+        if self._operation("makedirs", path):
+            self._mark_written(path)
+        util.LocalFS.makedirs(self, path)
+
+    def remove(self, path):
+        if self._operation("remove", path):
+            self._visible_at.pop(realpath(path), None)
+        util.LocalFS.remove(self, path)
+
+    def rmtree(self, path):
+        self._operation("rmtree", path)
+        util.LocalFS.rmtree(self, path)
+
+
+class _CloudFile(object):
+    """A file in the cloud that accounts, throttles and fails the I/O"""
+
+    def __init__(self, cloud, f, path, write, fail):
+        self._cloud = cloud
+        self._f = f
+        self._path = path
+        self._write = write
+        self._fail = fail
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.readline, self._f.read(0))
+
+    def read(self, *args):
+        data = self._f.read(*args)
+        self._cloud._transfer(len(data), write=False)
+        return data
+
+    def readline(self, *args):
+        data = self._f.readline(*args)
+        self._cloud._transfer(len(data), write=False)
+        return data
+
+    def write(self, data):
+        if self._fail:
+            self._f.write(data[:len(data) // 2])
+            self._f.flush()
+            raise InjectedFailure(errno.EIO, "Injected partial write", self._path)
+        self._cloud._transfer(len(data), write=True)
+        return self._f.write(data)
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+            if self._write:
+                self._cloud._mark_written(self._path)
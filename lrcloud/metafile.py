@@ -16,45 +16,96 @@ from os.path import join, dirname, isabs
 from . import util
 
 DATETIME_FORMAT='%Y-%m-%d %H:%M:%S.%f'
+ENCODINGS = ['ini', 'json']
+
+def parse_datetime(value):
+    """Return 'value' as a datetime object or None when it isn't a timestamp"""
+
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(value, DATETIME_FORMAT)
+    except (ValueError, TypeError):
+        return None
+
 
 class MetaFile:
-    """Representation of a meta-file"""
+    """Representation of a meta-file
+
+    Values are kept as the strings found in the file except for booleans
+    and filenames, which are made absolute. Use the typed accessors, such
+    as get_datetime(), to parse a value when it is actually needed.
 
-    def __init__(self, file_path):
+    The file is either an ini file (the default) or a JSON file, which is
+    much faster to read. The encoding of an existing file is detected
+    automatically and 'encoding' only decides how flush() writes the file.
+    """
+
+    def __init__(self, file_path, encoding=None):
         self.file_path = file_path
-        config = cparser.ConfigParser()
-        config.read(file_path)
-        logging.info("Read meta-data file: %s"%file_path)
         self._data = {}
-        for sec in config.sections():
-            self._data[sec] = {}
-            for (name, value) in config.items(sec):
-                if value == "True":
-                    value = True
-                elif value == "False":
-                    value = False
-                try:# Try to convert the value to a time object
-                   t = datetime.strptime(value, DATETIME_FORMAT)
-                   value = t
-                except ValueError:
-                    pass
-                except TypeError:
-                    pass
-                if name == "filename" and not isabs(value):
-                    value = join(dirname(file_path), value) # Make filenames absolute
-                self._data[sec][name] = value
+        detected = None
+        if util.fs.isfile(file_path):
+            with util.fs.open(file_path, 'r') as f:
+                content = f.read()
+            if content.lstrip().startswith('{'):
+                import json
+                detected = 'json'
+                sections = json.loads(content)
+            else:
+                detected = 'ini'
+                config = cparser.ConfigParser()
+                if sys.version_info >= (3,):
+                    config.read_string(content, source=file_path)
+                else:
+                    from StringIO import StringIO
+                    config.readfp(StringIO(content), file_path)
+                sections = dict((sec, config.items(sec)) for sec in config.sections())
+            logging.info("Read meta-data file: %s"%file_path)
+            for (sec, items) in sections.items():
+                if isinstance(items, dict):
+                    items = items.items()
+                self._data[sec] = {}
+                for (name, value) in items:
+                    if value == "True":
+                        value = True
+                    elif value == "False":
+                        value = False
+                    if name == "filename" and not isabs(value):
+                        value = join(dirname(file_path), value) # Make filenames absolute
+                    self._data[sec][name] = value
+        self.encoding = encoding or detected or 'ini'
+        if self.encoding not in ENCODINGS:
+            raise ValueError("Unknown meta-data encoding: %s"%self.encoding)
 
     def __getitem__(self, section):
         if section not in self._data:
             self._data[section] = {}
         return self._data[section]
 
+    def get_datetime(self, section, name):
+        """Return the value as a datetime object or None when not a timestamp"""
+        return parse_datetime(self[section].get(name))
+
     def flush(self):
         logging.info("Writing meta-data file: %s"%self.file_path)
+        if self.encoding == 'json':
+            import json
+            data = {}
+            for (sec, options) in self._data.items():
+                data[sec] = {}
+                for (name, value) in options.items():
+                    if not isinstance(value, bool):
+                        value = str(value)
+                    data[sec][name] = value
+            with util.fs.open(self.file_path, 'w') as f:
+                json.dump(data, f, sort_keys=True)
+            return
+
         config = cparser.ConfigParser()
         for (sec, options) in self._data.items():
             config.add_section(sec)
             for (name, value) in options.items():
                 config.set(sec, name, str(value))
-        with open(self.file_path, 'w') as f:
+        with util.fs.open(self.file_path, 'w') as f:
             config.write(f)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Page-level diff and patch of catalogs
+
+A patch is the pages of the new catalog that differ from the old catalog
+and the size of the new catalog. The page size is the one of the SQLite
+database (Lightroom catalogs are SQLite databases) or DEFAULT_PAGE_SIZE.
+Because a patch says exactly which pages it changes, patches that do not
+touch the same pages can be rebased onto each other (see rebase.py).
+
+This is the builtin backend used when no --diff-cmd/--patch-cmd is given
+but it can also be used as an external command:
+
+    $ python -m lrcloud.pagediff diff OLD NEW PATCH
+    $ python -m lrcloud.pagediff patch OLD PATCH NEW
+
+The format is a header (MAGIC, page size: uint32, new size: uint64)
+followed by records (page index: uint64, page content) and terminated
+by the page index END. All integers are little-endian and the length of
+a page is the page size except for the last page of the catalog.
+Anything after END is ignored.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import struct
+
+MAGIC = b"LRCPAGE1"
+HEADER = struct.Struct("<8sIQ")
+INDEX = struct.Struct("<Q")
+END = 2**64 - 1
+DEFAULT_PAGE_SIZE = 4096
+SQLITE_MAGIC = b"SQLite format 3\x00"
+BLOCK_SIZE = 2**20  # Blocks are compared before the pages within them
+
+
+def sqlite_page_size(header):
+    """Return the page size given the first bytes of a SQLite database
+       or None when it isn't a SQLite database"""
+
+    if len(header) < 18 or not header.startswith(SQLITE_MAGIC):
+        return None
+    (size,) = struct.unpack(">H", header[16:18])
+    return 65536 if size == 1 else size
+
+
+def page_size_of(path):
+    """Return the page size of the catalog 'path'"""
+
+    with open(path, 'rb') as f:
+        return sqlite_page_size(f.read(18)) or DEFAULT_PAGE_SIZE
+
+
+def is_patch(path):
+    """Return whether the file 'path' is a page-level patch"""
+
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def diff(old, new, out, page_size=None):
+    """Write the patch that turns 'old' into 'new' to 'out'"""
+
+    page_size = page_size or page_size_of(new)
+    new_size = os.path.getsize(new)
+    block_size = page_size * max(1, BLOCK_SIZE // page_size)
+    with open(old, 'rb') as fold, open(new, 'rb') as fnew, open(out, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, page_size, new_size))
+        offset = 0
+        while True:
+            nblock = fnew.read(block_size)
+            if not nblock:
+                break
+            oblock = fold.read(block_size)
+            if nblock != oblock:
+                for i in range(0, len(nblock), page_size):
+                    npage = nblock[i:i+page_size]
+                    if npage != oblock[i:i+page_size]:
+                        f.write(INDEX.pack((offset + i) // page_size))
+                        f.write(npage)
+            offset += len(nblock)
+        f.write(INDEX.pack(END))
+
+
+def read_header(f):
+    """Return the (page size, new size) of the patch file object 'f'"""
+
+    (magic, page_size, new_size) = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("Not a page-level patch")
+    return (page_size, new_size)
+
+
+def iter_pages(f, page_size, new_size):
+    """Yield the (page index, content) of the patch file object 'f',
+       which must be positioned after the header"""
+
+    while True:
+        (index,) = INDEX.unpack(f.read(INDEX.size))
+        if index == END:
+            return
+        length = min(page_size, new_size - index * page_size)
+        data = f.read(length)
+        if len(data) != length:
+            raise ValueError("Truncated page-level patch")
+        yield (index, data)
+
+
+def read_patch(f):
+    """Return the (page size, new size, {page index: content}) of the
+       patch file object 'f'"""
+
+    (page_size, new_size) = read_header(f)
+    return (page_size, new_size, dict(iter_pages(f, page_size, new_size)))
+
+
+def write_patch(out, page_size, new_size, pages, trailer=b""):
+    """Write a patch of the {page index: content} dict 'pages' to 'out'.
+       The 'trailer' is written after END thus it doesn't change the patch"""
+
+    with open(out, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, page_size, new_size))
+        for index in sorted(pages):
+            f.write(INDEX.pack(index))
+            f.write(pages[index])
+        f.write(INDEX.pack(END))
+        f.write(trailer)
+
+
+def patch_inplace(catalog, patch):
+    """Apply 'patch' to 'catalog' by only writing the changed pages"""
+
+    with open(patch, 'rb') as p, open(catalog, 'r+b') as c:
+        (page_size, new_size) = read_header(p)
+        for (index, data) in iter_pages(p, page_size, new_size):
+            c.seek(index * page_size)
+            c.write(data)
+        c.truncate(new_size)
+
+
+def patch(old, patch_file, out):
+    """Write 'old' with 'patch_file' applied to 'out'"""
+
+    import shutil
+    if old != out:
+        shutil.copyfile(old, out)
+    patch_inplace(out, patch_file)
+
+
+def main(argv=None):
+    import sys
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 4 and argv[0] == "diff":
+        diff(argv[1], argv[2], argv[3])
+    elif len(argv) == 4 and argv[0] == "patch":
+        patch(argv[1], argv[2], argv[3])
+    else:
+        sys.exit("usage: python -m lrcloud.pagediff diff OLD NEW PATCH\n"
+                 "       python -m lrcloud.pagediff patch OLD PATCH NEW")
+
+if __name__ == "__main__":
+    main()
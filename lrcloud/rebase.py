@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Rebase of a branch of page-level changesets onto another branch
+
+When two machines push from the same parent the ChangesetDAG forks. The
+branch that loses (see ChangesetDAG.wins()) is rebased onto the leaf of
+the winner by a three-way merge of the pages the losing branch changed:
+a page changed by both branches is a conflict unless both made the same
+change. The first page of a SQLite database starts with the header,
+which is merged field by field. Its file change counter is set higher
+than on both branches thus SQLite notices that the database changed.
+
+The merged changeset is pushed as a child of the winning leaf and names
+the losing leaf in 'merges', which makes the losing branch dead.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import struct
+
+from . import util
+from . import pagediff
+
+# The (start, end) byte ranges of the fields of the SQLite header, which is
+# documented at <https://www.sqlite.org/fileformat.html#the_database_header>
+SQLITE_HEADER_SIZE = 100
+SQLITE_HEADER_FIELDS = [(0, 16), (16, 18), (18, 19), (19, 20), (20, 21), (21, 22),
+                        (22, 23), (23, 24), (24, 28), (28, 32), (32, 36), (36, 40),
+                        (40, 44), (44, 48), (48, 52), (52, 56), (56, 60), (60, 64),
+                        (64, 68), (68, 72), (72, 92), (92, 96), (96, 100)]
+
+# The fields set by rebase() itself: the file change counter, the database size
+# in pages, the version-valid-for number and the SQLite version number
+SQLITE_DERIVED = set([(24, 28), (28, 32), (92, 96), (96, 100)])
+
+
+class RebaseConflict(RuntimeError):
+    """The branch cannot be rebased"""
+    pass
+
+
+class _Catalogs(object):
+    """Page-level access to the catalog as of any changeset in the DAG.
+    Only the headers of the patches are kept in memory, the pages are
+    streamed from the changesets when requested"""
+
+    def __init__(self, dag):
+        self.dag = dag
+        self._headers = {} # Hash to (page size, size)
+
+    @staticmethod
+    def _read_header(node, f):
+        try:
+            return pagediff.read_header(f)
+        except (ValueError, struct.error):
+            raise RebaseConflict("The changeset %s is not a page-level "
+                                 "patch"%node.filename)
+
+    def header(self, node):
+        """Return the (page size, size) of the changeset 'node'"""
+
+        if node.hash not in self._headers:
+            with util.open_content(node.filename) as f:
+                self._headers[node.hash] = self._read_header(node, f)
+        return self._headers[node.hash]
+
+    def iter_pages(self, node):
+        """Yield the (page index, content) of the changeset 'node'"""
+
+        with util.open_content(node.filename) as f:
+            self._headers[node.hash] = self._read_header(node, f)
+            (page_size, size) = self._headers[node.hash]
+            try:
+                for page in pagediff.iter_pages(f, page_size, size):
+                    yield page
+            except (ValueError, struct.error):
+                raise RebaseConflict("The changeset %s is truncated"%node.filename)
+
+    def size(self, node):
+        if node.is_base:
+            return util.content_size(node.filename)
+        return self.header(node)[1]
+
+    def pages(self, node, indexes, page_size, stop=None, stop_pages=None):
+        """Return the content of the pages 'indexes' as of the changeset 'node'.
+           The pages not changed after the ancestor 'stop' are taken from
+           'stop_pages', which are the pages 'indexes' as of 'stop'"""
+
+        size = self.size(node)
+        ret = {}
+        todo = set()
+        for index in indexes:
+            if index * page_size >= size:
+                ret[index] = b""
+            else:
+                todo.add(index)
+        while len(todo) > 0 and not node.is_base and node is not stop:
+            psize = self.header(node)[0]
+            if psize != page_size:
+                raise RebaseConflict("The changeset %s has the page size %d and "
+                                     "not %d"%(node.filename, psize, page_size))
+            for (index, data) in self.iter_pages(node):
+                if index in todo:
+                    ret[index] = data[:size - index * page_size]
+                    todo.remove(index)
+            node = node.parent
+        if len(todo) > 0 and node is stop:
+            for index in todo:
+                ret[index] = stop_pages[index][:size - index * page_size]
+        elif len(todo) > 0:
+            # The remaining pages are read from the base in one pass
+            with util.open_content(node.filename) as f:
+                offset = 0
+                for index in sorted(todo):
+                    skip = index * page_size - offset
+                    while skip > 0:
+                        nbytes = len(f.read(min(skip, 2**20)))
+                        if nbytes == 0:
+                            break
+                        skip -= nbytes
+                    data = f.read(page_size)
+                    offset = index * page_size + len(data)
+                    ret[index] = data[:size - index * page_size]
+        return ret
+
+
+def merge_header(page, base, winner, loser):
+    """Return the first page of a SQLite database merged from the three versions.
+       The header is merged field by field and the fields in SQLITE_DERIVED
+       are the winner's (see rebase())"""
+
+    (base, winner, loser) = (bytearray(base), bytearray(winner), bytearray(loser))
+    n = SQLITE_HEADER_SIZE
+    if loser[n:] == base[n:]:
+        body = winner[n:]
+    elif winner[n:] == base[n:] or winner[n:] == loser[n:]:
+        body = loser[n:]
+    else:
+        raise RebaseConflict("Both branches changed page %d"%(page + 1))
+    header = winner[:n]
+    for (start, end) in SQLITE_HEADER_FIELDS:
+        if (start, end) in SQLITE_DERIVED or loser[start:end] == base[start:end]:
+            continue
+        if winner[start:end] != base[start:end] and winner[start:end] != loser[start:end]:
+            raise RebaseConflict("Both branches changed the field at offset %d of "
+                                 "the SQLite header"%start)
+        header[start:end] = loser[start:end]
+    return bytes(header + body)
+
+
+def rebase(dag, winner, loser):
+    """Return the changeset that applies the changes of the branch of the node
+       'loser' to the node 'winner' as (page size, size, {page index: content}).
+       Raises RebaseConflict when the branches changed the same pages or when
+       a changeset of the branches is not a page-level patch"""
+
+    catalogs = _Catalogs(dag)
+    (branch, base) = dag.fork(loser, winner)
+    (winner_branch, _) = dag.fork(winner, loser)
+
+    # Every changeset of both branches must be page-level
+    page_size = None
+    for node in branch + winner_branch:
+        (psize, _) = catalogs.header(node)
+        if page_size not in (None, psize):
+            raise RebaseConflict("The branches have different page sizes")
+        page_size = psize
+    if page_size is None:
+        page_size = pagediff.DEFAULT_PAGE_SIZE
+
+    # The pages changed by the losing branch
+    changed = set()
+    for node in branch:
+        changed.update(index for (index, _) in catalogs.iter_pages(node))
+
+    (bsize, wsize, lsize) = [catalogs.size(n) for n in (base, winner, loser)]
+    if lsize == bsize or lsize == wsize:
+        size = wsize
+    elif wsize == bsize:
+        size = lsize
+    else:
+        raise RebaseConflict("Both branches changed the size of the catalog")
+
+    # The SQLite header is always merged
+    indexes = sorted(changed | set([0]))
+    bpages = catalogs.pages(base, indexes, page_size)
+    (wpages, lpages) = [catalogs.pages(n, indexes, page_size, base, bpages)
+                        for n in (winner, loser)]
+    sqlite = wpages[0][:len(pagediff.SQLITE_MAGIC)] == pagediff.SQLITE_MAGIC \
+             and len(wpages[0]) >= SQLITE_HEADER_SIZE
+    pages = {}
+    for index in indexes:
+        (b, w, l) = (bpages[index], wpages[index], lpages[index])
+        if l == b or l == w:
+            continue
+        if w != b and not (index == 0 and sqlite):
+            raise RebaseConflict("Both branches changed page %d"%(index + 1))
+        if index == 0 and sqlite:
+            if len(l) < SQLITE_HEADER_SIZE or len(b) < SQLITE_HEADER_SIZE:
+                raise RebaseConflict("The SQLite header is missing on a branch")
+            pages[index] = merge_header(index, b, w, l)
+        else:
+            pages[index] = l
+
+    if sqlite and len(pages) > 0:
+        # The change counter must be higher than on both branches and the
+        # database size must be the merged size
+        page = bytearray(pages.get(0, wpages[0]))
+        (wcounter,) = struct.unpack(">I", bytes(wpages[0][24:28]))
+        (lcounter,) = struct.unpack(">I", bytes(lpages[0][24:28]))
+        counter = struct.pack(">I", (max(wcounter, lcounter) + 1) % 2**32)
+        page[24:28] = counter
+        page[28:32] = struct.pack(">I", size // page_size)
+        page[92:96] = counter
+        pages[0] = bytes(page)
+
+    for (index, data) in pages.items():
+        if len(data) != min(page_size, size - index * page_size):
+            raise RebaseConflict("Page %d doesn't fit the merged catalog"%(index + 1))
+    return (page_size, size, pages)
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+from collections import namedtuple
+from os.path import join, basename, isfile
+from datetime import datetime
+
+from . import util
+from .util import lock_file, unlock_file, copy_smart_previews, hashsum
+from .metafile import MetaFile, DATETIME_FORMAT
+from .changeset import Node, ChangesetDAG
+from .stats import Stats
+
+# The result of SyncSession.pull(): the hashes of the applied changesets
+# and the hash of the cloud leaf the local catalog is now in sync with
+PullResult = namedtuple('PullResult', ['applied', 'leaf'])
+
+# The result of SyncSession.push(): the hash and filename of the new changeset,
+# which are None when the local catalog was unchanged thus nothing was pushed
+PushResult = namedtuple('PushResult', ['changeset', 'filename', 'parent'])
+
+# The result of SyncSession.status()
+SyncStatus = namedtuple('SyncStatus', ['last_push', 'leaf', 'behind', 'modified', 'locked'])
+
+
+class SyncSession(object):
+    """A long-lived synchronization between a local and a cloud catalog
+
+    The session keeps the ChangesetDAG of the cloud catalog in memory and
+    only reads new meta-files when refreshing it. Errors are raised as
+    exceptions (RuntimeError) rather than exiting thus many catalogs can
+    be synced from within one process. The timing and I/O of every phase
+    is recorded in 'stats' (see stats.Stats):
+
+        session = SyncSession(local_catalog, cloud_catalog, diff_cmd, patch_cmd)
+        session.pull()
+        ... # Lightroom edits the local catalog
+        session.push()
+
+    Without 'diff_cmd' and 'patch_cmd' the builtin page-level diff is used
+    (see pagediff.py), which also makes pull() able to rebase branches made
+    by machines that pushed concurrently (see rebase.py).
+    """
+
+    def __init__(self, local_catalog, cloud_catalog, diff_cmd=None,
+                 patch_cmd=None, smart_previews=True, metafile_encoding=None,
+                 stats=None):
+        self.local_catalog = local_catalog
+        self.cloud_catalog = cloud_catalog
+        self.diff_cmd = diff_cmd
+        self.patch_cmd = patch_cmd
+        self.smart_previews = smart_previews
+        self.metafile_encoding = metafile_encoding
+        self.stats = stats if stats is not None else Stats()
+        self._dag = None
+
+    @classmethod
+    def from_args(cls, args, stats=None):
+        """Return a session using the command line arguments 'args'"""
+        return cls(args.local_catalog, args.cloud_catalog, args.diff_cmd,
+                   args.patch_cmd, not args.no_smart_previews,
+                   args.metafile_encoding, stats)
+
+    @property
+    def local_metafile(self):
+        return "%s.lrcloud"%self.local_catalog
+
+    @property
+    def backup(self):
+        return "%s.backup"%self.local_catalog
+
+    @property
+    def client_marker(self):
+        """The cloud meta-file that records the last push of this machine, which
+           keeps the changesets it needs from being garbage collected (see --gc)"""
+
+        import socket
+        import hashlib
+        from os.path import abspath
+        client = "%s:%s"%(socket.gethostname(), abspath(self.local_catalog))
+        cid = hashlib.sha1(client.encode('utf-8')).hexdigest()[:16]
+        return "%s_client_%s.lrcloud"%(self.cloud_catalog, cid)
+
+    @property
+    def dag(self):
+        """The ChangesetDAG of the cloud catalog as of the last refresh"""
+        if self._dag is None:
+            self.refresh()
+        return self._dag
+
+    def refresh(self):
+        """Read the cloud changesets that are new since the last refresh.
+           Returns the list of new nodes"""
+
+        if not util.fs.isfile(self.cloud_catalog):
+            raise RuntimeError("The cloud catalog does not exist: %s"%self.cloud_catalog)
+        with self.stats.phase("dag") as phase:
+            if self._dag is None:
+                self._dag = ChangesetDAG(self.cloud_catalog)
+                new = list(self._dag.nodes.values())
+            else:
+                new = self._dag.update()
+            phase.read(*["%s.lrcloud"%n.filename for n in new])
+            phase.info['new_changesets'] = len(new)
+        return new
+
+    def _lock(self):
+        if not isfile(self.local_catalog):
+            raise RuntimeError("The local catalog does not exist: %s"%self.local_catalog)
+        with self.stats.phase("lock"):
+            logging.info("Locking local catalog: %s"%(self.local_catalog))
+            if not lock_file(self.local_catalog):
+                raise RuntimeError("The catalog %s is locked!"%self.local_catalog)
+
+    def _unlock(self):
+        logging.info("Unlocking local catalog: %s"%(self.local_catalog))
+        unlock_file(self.local_catalog)
+
+    def _make_backup(self):
+        """Backup the local catalog (overwriting old backup)"""
+        with self.stats.phase("backup") as phase:
+            logging.info("Removed old backup: %s"%self.backup)
+            util.remove(self.backup)
+            util.copy(self.local_catalog, self.backup)
+            phase.read(self.local_catalog)
+            phase.wrote(self.backup)
+
+    def _hashsum(self, filename):
+        with self.stats.phase("hash") as phase:
+            ret = hashsum(filename)
+            phase.read(filename)
+        return ret
+
+    def _record_catalog(self, lmfile, chash):
+        """Record the hash and the state (see util.catalog_state()) of the local catalog"""
+        lmfile['catalog']['hash'] = chash
+        lmfile['catalog'].update(util.catalog_state(self.local_catalog))
+
+    def _modified(self, lmfile):
+        """Return whether the local catalog differs from the one recorded in 'lmfile'.
+           The size and SQLite change counter tell when the catalog changed and an
+           unchanged mtime, which is older than the recording, when it didn't.
+           Otherwise the hash decides"""
+
+        catalog = lmfile['catalog']
+        with self.stats.phase("dirty") as phase:
+            state = util.catalog_state(self.local_catalog)
+            if catalog.get('size') is None:
+                modified = None # Not recorded by older versions
+            elif catalog.get('size') != state['size'] \
+                 or catalog.get('change_counter') != state['change_counter']:
+                modified = True
+            elif util.same_mtime(catalog, state):
+                modified = False
+            else:
+                modified = None
+            phase.info['modified'] = modified
+        if modified is None:
+            modified = self._hashsum(self.local_catalog) != catalog.get('hash')
+        return modified
+
+    def _flush(self, mfile):
+        with self.stats.phase("metadata") as phase:
+            mfile.flush()
+            phase.wrote(mfile.file_path)
+
+    def _mark_client(self, node):
+        """Record in the cloud that this machine's last push is 'node'"""
+
+        import socket
+        from os.path import abspath
+        mfile = MetaFile(self.client_marker, self.metafile_encoding)
+        mfile['client']['last_push'] = node.hash
+        mfile['client']['modification_utc'] = datetime.utcnow().strftime(DATETIME_FORMAT)[:-4]
+        mfile['client']['hostname'] = socket.gethostname()
+        mfile['client']['local_catalog'] = abspath(self.local_catalog)
+        self._flush(mfile)
+
+    def _copy_smart_previews(self, local2cloud):
+        if self.smart_previews:
+            with self.stats.phase("smart_previews") as phase:
+                nbytes = copy_smart_previews(self.local_catalog, self.cloud_catalog,
+                                             local2cloud=local2cloud)
+                if local2cloud:
+                    phase.bytes_written += nbytes
+                else:
+                    phase.bytes_read += nbytes
+
+    def status(self):
+        """Return the SyncStatus of the local catalog. 'behind' is None when the
+           local catalog isn't on the branch of the leaf"""
+
+        self.refresh()
+        lmfile = MetaFile(self.local_metafile)
+        last_push = lmfile['last_push'].get('hash')
+        leaf = self.dag.leaf.hash
+        behind = None
+        if self.dag.is_ancestor(last_push, leaf):
+            behind = len(self.dag.path(last_push, leaf))
+        modified = self._modified(lmfile)
+        locked = isfile("%s.lock"%self.local_catalog)
+        return SyncStatus(last_push, leaf, behind, modified, locked)
+
+    def _publish(self, tmp_patch, parent, merges=None, catalog_hash=None):
+        """Upload the patch 'tmp_patch' as a changeset of 'parent', which merges
+           the branch of the leaf 'merges' (if not None). The hash of the catalog
+           the changeset results in is recorded when known, which lets --verify
+           check the replay of the changesets. Returns the new node"""
+
+        ccat = self.cloud_catalog
+        chash = self._hashsum(tmp_patch)
+        patch = "%s_%s.zip"%(ccat, chash)
+        with self.stats.phase("compress") as phase:
+            util.copy(tmp_patch, patch)
+            phase.read(tmp_patch)
+            phase.wrote(patch)
+
+        # Write cloud meta-data
+        mfile = MetaFile("%s.lrcloud"%patch, self.metafile_encoding)
+        utcnow = datetime.utcnow().strftime(DATETIME_FORMAT)[:-4]
+        mfile['changeset']['is_base'] = False
+        mfile['changeset']['hash'] = chash
+        mfile['changeset']['modification_utc'] = utcnow
+        mfile['changeset']['filename'] = basename(patch)
+        if merges is not None:
+            mfile['changeset']['merges'] = merges
+        if catalog_hash is not None:
+            mfile['changeset']['catalog_hash'] = catalog_hash
+        mfile['parent']['is_base']          = parent.is_base
+        mfile['parent']['hash']             = parent.hash
+        mfile['parent']['modification_utc'] = parent.modification_utc
+        mfile['parent']['filename']         = basename(parent.filename)
+        self._flush(mfile)
+        node = Node(chash, patch, False, parent.hash, utcnow, merges, catalog_hash)
+        self.dag.add([node])
+        return node
+
+    def _rebase(self, tmpdir, lmfile):
+        """Rebase the live branches that lose onto the leaf (see ChangesetDAG.leaf)
+           and publish the merged changesets. Branches that conflict are left
+           as they are and recorded in the 'conflicts' section of the local
+           meta-file 'lmfile' thus they are only retried when the leaf changes"""
+
+        from . import rebase
+        from . import pagediff
+
+        winner = self.dag.leaf
+        losers = [n for n in self.dag.live_leafs if n is not winner]
+        conflicts = lmfile['conflicts']
+        recorded = dict(conflicts)
+        for chash in set(conflicts) - set(n.hash for n in losers):
+            del conflicts[chash]
+        for loser in sorted(losers, key=lambda n: n.hash):
+            if conflicts.get(loser.hash) == winner.hash:
+                logging.info("Skipping %s, which conflicts with %s"%(loser.hash, winner.hash))
+                continue
+            with self.stats.phase("rebase", changeset=loser.hash) as phase:
+                try:
+                    (page_size, size, pages) = rebase.rebase(self.dag, winner, loser)
+                except rebase.RebaseConflict as e:
+                    logging.warning("Cannot rebase %s onto %s: %s"%(loser.hash, winner.hash, e))
+                    phase.info['conflict'] = str(e)
+                    conflicts[loser.hash] = winner.hash
+                    continue
+                logging.info("Rebasing %s onto %s"%(loser.hash, winner.hash))
+                # The trailer makes the hash of a merge unique even when its pages
+                # are identical to the ones of an existing changeset
+                tmp_patch = join(tmpdir, "merge.patch")
+                trailer = ("merges %s onto %s"%(loser.hash, winner.hash)).encode('ascii')
+                pagediff.write_patch(tmp_patch, page_size, size, pages, trailer)
+                phase.wrote(tmp_patch)
+            winner = self._publish(tmp_patch, winner, merges=loser.hash)
+        if conflicts != recorded:
+            self._flush(lmfile)
+
+    def _abandon(self, tmpdir, losers, winner, catalog_hash):
+        """Publish empty changesets onto 'winner' that merge the leafs 'losers'
+           thus their branches are dead. The local catalog, which has the hash
+           'catalog_hash', must be the catalog of 'winner'. Returns the new leaf"""
+
+        import os
+        from . import pagediff
+
+        page_size = pagediff.page_size_of(self.local_catalog)
+        size = os.path.getsize(self.local_catalog)
+        for loser in losers:
+            logging.warning("Abandoning the changeset %s"%loser.hash)
+            tmp_patch = join(tmpdir, "abandon.patch")
+            trailer = ("abandons %s onto %s"%(loser.hash, winner.hash)).encode('ascii')
+            pagediff.write_patch(tmp_patch, page_size, size, {}, trailer)
+            winner = self._publish(tmp_patch, winner, loser.hash, catalog_hash)
+        return winner
+
+    def pull(self, reset=False):
+        """Apply the cloud changesets missing in the local catalog and make
+           a backup of the result, which push() diffs against.
+           Branches that were pushed concurrently are rebased first.
+           A local branch that cannot be rebased makes the pull fail unless
+           'reset' is True, in which case the local changesets are discarded
+           and the local catalog is synced to the cloud leaf.
+           Returns a PullResult"""
+
+        import shutil
+        import tempfile
+
+        lcat = self.local_catalog
+        self.refresh()
+        self._lock()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            #Backup the local catalog before changing it
+            self._make_backup()
+
+            lmfile = MetaFile(self.local_metafile, self.metafile_encoding)
+            if self.dag.forked or len(lmfile['conflicts']) > 0:
+                self._rebase(tmpdir, lmfile)
+
+            #Apply changesets
+            leaf = self.dag.leaf
+            last_push = lmfile['last_push']['hash']
+            replayed = False
+            abandoned = []
+            lhash = None
+            if last_push not in self.dag.nodes:
+                raise RuntimeError("The changeset %s of the local catalog is not in "\
+                                   "the cloud"%last_push)
+            if not self.dag.is_ancestor(last_push, leaf.hash) and \
+               last_push not in self.dag.ancestors(leaf.hash):
+                if not reset:
+                    raise RuntimeError("The changeset %s of the local catalog conflicts with "\
+                                       "the cloud leaf %s and cannot be rebased. Use "\
+                                       "--reset-to-cloud to discard the local changesets"\
+                                       %(last_push, leaf.hash))
+                #The local changesets are discarded by abandoning their branch
+                abandoned = [n for n in self.dag.live_leafs
+                             if n is not leaf and self.dag.is_ancestor(last_push, n.hash)]
+            if self.dag.is_ancestor(last_push, leaf.hash):
+                path = self.dag.path(last_push, leaf.hash)
+            else:
+                #Our branch was rebased or abandoned thus we replay the changesets
+                #from the base
+                logging.info("The changeset %s was rebased or abandoned, replaying from "\
+                             "the base"%last_push)
+                with self.stats.phase("compress") as phase:
+                    util.copy(self.cloud_catalog, lcat)
+                    phase.read(self.cloud_catalog)
+                    phase.wrote(lcat)
+                path = self.dag.path(self.dag.root.hash, leaf.hash)
+                replayed = True
+            if len(path) > 0:
+                util.apply_changesets(self, path, lcat, self.stats)
+            if len(abandoned) > 0:
+                lhash = self._hashsum(lcat)
+                leaf = self._abandon(tmpdir, abandoned, leaf, lhash)
+
+            #Let's copy Smart Previews
+            self._copy_smart_previews(local2cloud=False)
+
+            #The backup is now the state of the cloud leaf
+            self._make_backup()
+
+            #Record that the local catalog is in sync with the leaf
+            if leaf.hash != last_push:
+                self._record_catalog(lmfile, lhash or self._hashsum(lcat))
+                lmfile['catalog']['modification_utc'] = datetime.utcnow().strftime(DATETIME_FORMAT)[:-4]
+                lmfile['last_push']['filename'] = leaf.filename
+                lmfile['last_push']['hash'] = leaf.hash
+                lmfile['last_push']['modification_utc'] = leaf.modification_utc
+                self._flush(lmfile)
+            if replayed:
+                #Our branch is no longer needed
+                self._mark_client(leaf)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            self._unlock()
+        return PullResult([n.hash for n in path], leaf.hash)
+
+    def push(self):
+        """Push the changes made to the local catalog since the last pull()
+           as a new changeset. Nothing is pushed when the catalog is unchanged.
+           Returns a PushResult"""
+
+        import shutil
+        import subprocess
+        import tempfile
+
+        lcat = self.local_catalog
+        if not isfile(self.backup):
+            raise RuntimeError("No backup of the last pull, call pull() first: %s"%self.backup)
+        self._lock()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            lmfile = MetaFile(self.local_metafile, self.metafile_encoding)
+            parent = self.dag.nodes[lmfile['last_push']['hash']]
+            if not self._modified(lmfile):
+                logging.info("The local catalog is unchanged, nothing to push")
+                #Record the mtime thus the next push doesn't need the hash
+                state = util.catalog_state(lcat)
+                if not util.same_mtime(lmfile['catalog'], state):
+                    lmfile['catalog'].update(state)
+                    self._flush(lmfile)
+                self._copy_smart_previews(local2cloud=True)
+                return PushResult(None, None, parent.hash)
+            tmp_patch = join(tmpdir, "tmp.patch")
+
+            with self.stats.phase("diff") as phase:
+                if self.diff_cmd is None:
+                    logging.info("Diff (page-level): %s %s"%(self.backup, lcat))
+                    from . import pagediff
+                    pagediff.diff(self.backup, lcat, tmp_patch)
+                else:
+                    diff_cmd = self.diff_cmd.replace("$in1", self.backup)\
+                                            .replace("$in2", lcat)\
+                                            .replace("$out", tmp_patch)
+                    logging.info("Diff: %s"%diff_cmd)
+                    subprocess.call(diff_cmd, shell=True)
+                phase.read(self.backup, lcat)
+                phase.wrote(tmp_patch)
+
+            lhash = self._hashsum(lcat)
+            node = self._publish(tmp_patch, parent, catalog_hash=lhash)
+
+            # Write local meta-data
+            self._record_catalog(lmfile, lhash)
+            lmfile['catalog']['modification_utc'] = node.modification_utc
+            lmfile['last_push']['filename'] = node.filename
+            lmfile['last_push']['hash'] = node.hash
+            lmfile['last_push']['modification_utc'] = node.modification_utc
+            self._flush(lmfile)
+            self._mark_client(node)
+
+            #The backup is now the state of the new changeset
+            self._make_backup()
+
+            #Let's copy Smart Previews
+            self._copy_smart_previews(local2cloud=True)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            self._unlock()
+        return PushResult(node.hash, node.filename, parent.hash)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import logging
+from os.path import getsize, isfile
+from contextlib import contextmanager
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+
+class Phase(object):
+    """The wall time and I/O of one phase of a sync"""
+
+    __slots__ = ('name', 'info', 'seconds', 'bytes_read', 'bytes_written')
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    # NB: the sizes are looked up directly thus the accounting itself
+    #     doesn't count as cloud operations (see util.fs). Missing files,
+    #     e.g. the output of a failed diff command, count as empty
+
+    def read(self, *paths):
+        """Account the size of the files 'paths' as read"""
+        for path in paths:
+            if isfile(path):
+                self.bytes_read += getsize(path)
+
+    def wrote(self, *paths):
+        """Account the size of the files 'paths' as written"""
+        for path in paths:
+            if isfile(path):
+                self.bytes_written += getsize(path)
+
+    def as_dict(self):
+        ret = dict(self.info)
+        ret.update({
+            'name': self.name,
+            'seconds': self.seconds,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'throughput': throughput(self.bytes_read + self.bytes_written, self.seconds),
+        })
+        return ret
+
+
+def throughput(nbytes, seconds):
+    """Return bytes per second or None when nothing was timed"""
+    return nbytes / seconds if seconds > 0 else None
+
+
+class Stats(object):
+    """Timing and I/O instrumentation of the phases of a sync
+
+    Wrap each phase in a 'with stats.phase(name) as phase:' block and account
+    its I/O with phase.read() and phase.wrote(). The report is a JSON
+    friendly dict, which can be written with dump() and is passed to 'hook'
+    by publish(), e.g. to export it to a monitoring system."""
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name, **info):
+        phase = Phase(name, info)
+        tic = timer()
+        try:
+            yield phase
+        finally:
+            phase.seconds = timer() - tic
+            self.phases.append(phase)
+            logging.info("Phase %s: %.3f sec, %d bytes read, %d bytes written"
+                         %(name, phase.seconds, phase.bytes_read, phase.bytes_written))
+
+    def report(self):
+        """Return the phases and the totals of each kind of phase"""
+
+        totals = {}
+        for phase in self.phases:
+            total = totals.setdefault(phase.name, {'count': 0, 'seconds': 0.0,
+                                                   'bytes_read': 0, 'bytes_written': 0})
+            total['count'] += 1
+            total['seconds'] += phase.seconds
+            total['bytes_read'] += phase.bytes_read
+            total['bytes_written'] += phase.bytes_written
+        for total in totals.values():
+            total['throughput'] = throughput(total['bytes_read'] + total['bytes_written'],
+                                             total['seconds'])
+        return {
+            'phases': [p.as_dict() for p in self.phases],
+            'totals': totals,
+            'seconds': sum(p.seconds for p in self.phases),
+        }
+
+    def dump(self, path):
+        """Write the report as JSON to 'path'"""
+
+        import json
+        logging.info("Writing stats: %s"%path)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def publish(self):
+        """Pass the report to the hook (if any)"""
+        if self.hook is not None:
+            self.hook(self.report())
+
+
+def load_hook(spec):
+    """Return the function named by 'spec', which is 'module:function'"""
+
+    import importlib
+    (module, _, name) = spec.partition(":")
+    if not module or not name:
+        raise ValueError("The stats hook must be given as 'module:function': %s"%spec)
+    return getattr(importlib.import_module(module), name)
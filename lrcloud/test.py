@@ -9,9 +9,21 @@ import tempfile
 from os.path import join, basename, dirname, isfile, abspath
 import shutil
 import sys
+import os
+import subprocess
+import json
+import argparse
 
 from . import __main__ as lrcloud
 from .metafile import MetaFile
+from . import util
+from .session import SyncSession
+from .fakecloud import FakeCloudFS, InjectedFailure
+
+# A "diff" that is the whole new catalog and a "patch" that is the diff
+COPY_CMD = '"%s" -c "import shutil,sys; shutil.copyfile(sys.argv[2], sys.argv[3])"'%sys.executable
+COPY_DIFF_CMD = "%s $in1 $in2 $out"%COPY_CMD
+COPY_PATCH_CMD = "%s $in1 $patch $out"%COPY_CMD
 
 def cmd_init_push_to_cloud(local_catalog, cloud_catalog):
     args = [
@@ -85,6 +97,735 @@ class InitPush(unittest.TestCase):
         self.check_catalog(self.lcat1, [1,2,1])
 
 
+class MetaFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def write_chain(self, length, encoding=None):
+        ccat = join(self.tmpdir, "cloud.lrcat")
+        mfile = MetaFile("%s.lrcloud"%ccat, encoding)
+        mfile['changeset']['is_base'] = True
+        mfile['changeset']['hash'] = "0"
+        mfile['changeset']['modification_utc'] = "2016-01-02 03:04:05.67"
+        mfile['changeset']['filename'] = "cloud.lrcat"
+        mfile.flush()
+        for i in range(1, length):
+            patch = "%s_%x.zip"%(ccat, i)
+            mfile = MetaFile("%s.lrcloud"%patch, encoding)
+            mfile['changeset']['is_base'] = False
+            mfile['changeset']['hash'] = "%x"%i
+            mfile['changeset']['filename'] = basename(patch)
+            mfile['parent']['hash'] = "%x"%(i-1)
+            mfile.flush()
+        return ccat
+
+    def testLazyValues(self):
+        ccat = self.write_chain(1)
+        mfile = MetaFile("%s.lrcloud"%ccat)
+        self.assertIs(mfile['changeset']['is_base'], True)
+        self.assertEqual(mfile['changeset']['modification_utc'], "2016-01-02 03:04:05.67")
+        self.assertEqual(mfile.get_datetime('changeset', 'modification_utc').microsecond, 670000)
+        self.assertIsNone(mfile.get_datetime('changeset', 'hash'))
+        self.assertEqual(mfile['changeset']['filename'], ccat)
+
+    def testJSON(self):
+        ccat = self.write_chain(2, encoding='json')
+        with open("%s.lrcloud"%ccat) as f:
+            self.assertTrue(f.read().startswith("{"))
+        mfile = MetaFile("%s.lrcloud"%ccat)
+        self.assertEqual(mfile.encoding, 'json')
+        self.assertIs(mfile['changeset']['is_base'], True)
+        self.assertEqual(mfile['changeset']['filename'], ccat)
+        dag = lrcloud.ChangesetDAG(ccat)
+        self.assertEqual([n.hash for n in dag.path("0", "1")], ["1"])
+
+    def testLongChain(self):
+        ccat = self.write_chain(2000)
+        dag = lrcloud.ChangesetDAG(ccat)
+        self.assertEqual(len(dag.nodes), 2000)
+        self.assertEqual(dag.leafs[0].hash, "%x"%1999)
+        self.assertEqual(dag.root.modification_time.year, 2016)
+        path = dag.path(dag.root.hash, dag.leafs[0].hash)
+        self.assertEqual([n.hash for n in path], ["%x"%i for i in range(1, 2000)])
+
+
+class Verify(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ccat = join(self.tmpdir, "cloud.zip")
+        self.lcat = join(self.tmpdir, "local.lrcat")
+        with open(self.lcat, mode='w') as f:
+            f.write("Init Lightroom Catalog\n")
+        self.run_lrcloud("--init-push-to-cloud")
+        for i in range(5):
+            self.run_lrcloud("--lightroom-exec-debug", "I am #%d"%i)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def run_lrcloud(self, *args):
+        lrcloud.main(["--config-file=None",
+                      "--local-catalog", self.lcat,
+                      "--cloud-catalog", self.ccat,
+                      "--diff-cmd", COPY_DIFF_CMD,
+                      "--patch-cmd", COPY_PATCH_CMD] + list(args))
+
+    def testValid(self):
+        self.run_lrcloud("--verify", "--jobs", "2")
+        self.run_lrcloud("--verify", "--verify-replay")
+        self.assertFalse(isfile("%s.lock"%self.lcat))
+
+    def testReplayHashesOnce(self):
+        hashed = []
+        def hashsum(filename):
+            hashed.append(filename)
+            return util.hashsum(filename)
+        (lrcloud.hashsum, original) = (hashsum, lrcloud.hashsum)
+        try:
+            args = argparse.Namespace(local_catalog=None, patch_cmd=COPY_PATCH_CMD)
+            self.assertEqual(lrcloud.verify_changesets(args, self.ccat, replay=True), [])
+        finally:
+            lrcloud.hashsum = original
+        self.assertEqual(len(hashed), 1)
+
+    def testCorruptChangeset(self):
+        dag = lrcloud.ChangesetDAG(self.ccat)
+        util.copy(self.lcat, dag.leafs[0].parent.filename)
+        with self.assertRaises(RuntimeError):
+            self.run_lrcloud("--verify")
+        problems = lrcloud.verify_changesets(None, self.ccat)
+        self.assertEqual(len(problems), 1)
+        self.assertIn(dag.leafs[0].parent.hash, problems[0])
+
+    def testReplayMismatch(self):
+        # A diff that corrupts the catalog, which only the replay notices
+        corrupt = '"%s" -c "import sys; open(sys.argv[1], \'a\').write(\'corrupt\')"'%sys.executable
+        for i in range(3):
+            self.run_lrcloud("--lightroom-exec-debug", "I am #4 again",
+                             "--diff-cmd", "%s $in1 $in2 $out && %s $out"%(COPY_CMD, corrupt))
+        dag = lrcloud.ChangesetDAG(self.ccat)
+        first = dag.leafs[0].parent.parent
+        self.assertEqual(lrcloud.verify_changesets(None, self.ccat), [])
+        # Replayed by another machine, which doesn't know the local catalog
+        args = argparse.Namespace(local_catalog=None, patch_cmd=COPY_PATCH_CMD)
+        problems = lrcloud.verify_changesets(args, self.ccat, replay=True)
+        self.assertEqual(len(problems), 1)
+        # The first changeset that doesn't give its catalog is found by bisection
+        self.assertIn(first.hash, problems[0])
+
+    def testMissingParent(self):
+        dag = lrcloud.ChangesetDAG(self.ccat)
+        os.remove("%s.lrcloud"%dag.leafs[0].parent.filename)
+        problems = lrcloud.verify_changesets(None, self.ccat)
+        self.assertEqual(len(problems), 1)
+        self.assertIn("parent", problems[0])
+
+
+class SessionFixture(unittest.TestCase):
+    """Two local catalogs sharing a cloud catalog"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(join(self.tmpdir, "cloud"))
+        self.ccat = join(self.tmpdir, "cloud", "cloud.zip")
+        self.lcat1 = join(self.tmpdir, "local1.lrcat")
+        self.lcat2 = join(self.tmpdir, "local2.lrcat")
+        self.create_catalog(self.lcat1)
+        cmd_init_push_to_cloud(self.lcat1, self.ccat)
+        shutil.copy(self.lcat1, self.lcat2)
+        shutil.copy("%s.lrcloud"%self.lcat1, "%s.lrcloud"%self.lcat2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def create_catalog(self, lcat):
+        with open(lcat, mode='w') as f:
+            f.write("Init Lightroom Catalog\n")
+
+    def session(self, lcat):
+        return SyncSession(lcat, self.ccat, COPY_DIFF_CMD, COPY_PATCH_CMD)
+
+    def edit(self, lcat, line):
+        with open(lcat, "a") as f:
+            f.write(line)
+
+
+class Session(SessionFixture):
+
+    def testPullPush(self):
+        (s1, s2) = (self.session(self.lcat1), self.session(self.lcat2))
+        self.assertRaises(RuntimeError, s1.push)
+        self.assertEqual(s1.pull().applied, [])
+        self.edit(self.lcat1, "I am #1\n")
+        self.assertTrue(s1.status().modified)
+        pushed = s1.push()
+        self.assertEqual(pushed.parent, s1.dag.root.hash)
+        self.assertFalse(s1.status().modified)
+
+        self.assertEqual(s2.status().behind, 1)
+        self.assertEqual(s2.pull(), (([pushed.changeset]), pushed.changeset))
+        self.assertEqual(s2.status().behind, 0)
+        self.edit(self.lcat2, "I am #2\n")
+        s2.push()
+        # Pushing twice without pulling in between
+        self.edit(self.lcat2, "I am #2 again\n")
+        pushed = s2.push()
+
+        self.assertEqual(len(s1.pull().applied), 2)
+        self.assertEqual(s1.status(), (pushed.changeset, pushed.changeset, 0, False, False))
+        with open(self.lcat1) as f:
+            self.assertEqual(f.read(), "Init Lightroom Catalog\nI am #1\nI am #2\nI am #2 again\n")
+
+    def testUnchanged(self):
+        session = self.session(self.lcat1)
+        session.pull()
+        nodes = len(session.dag.nodes)
+        # Only the mtime changed thus the hash confirms that nothing changed
+        os.utime(self.lcat1, (0, 0))
+        self.assertEqual(session.push().changeset, None)
+        # The mtime is now recorded well after it thus no hash is needed
+        self.assertEqual(session.push().changeset, None)
+        self.assertEqual(len(session.dag.nodes), nodes)
+        names = [p.name for p in session.stats.phases]
+        self.assertNotIn("diff", names)
+        self.assertEqual(names.count("hash"), 1)
+        # The same size but another content
+        with open(self.lcat1, "r+") as f:
+            f.write("Edit")
+        os.utime(self.lcat1, (1, 1))
+        self.assertIsNotNone(session.push().changeset)
+        self.assertEqual(len(session.dag.nodes), nodes + 1)
+
+    def testRacyMtime(self):
+        session = self.session(self.lcat1)
+        session.pull()
+        # The catalog was recorded within the mtime resolution of its mtime
+        lmfile = MetaFile("%s.lrcloud"%self.lcat1)
+        mtime = float(lmfile['catalog']['mtime'])
+        lmfile['catalog']['recorded'] = repr(mtime)
+        lmfile.flush()
+        # An edit within the same tick that keeps the size and the mtime
+        with open(self.lcat1, "r+") as f:
+            f.write("Edit")
+        os.utime(self.lcat1, (mtime, mtime))
+        self.assertIsNotNone(session.push().changeset)
+
+    def testIncrementalRefresh(self):
+        (s1, s2) = (self.session(self.lcat1), self.session(self.lcat2))
+        self.assertEqual(len(s1.refresh()), 1)
+        s2.pull()
+        self.edit(self.lcat2, "I am #2\n")
+        pushed = s2.push()
+        s1.dag._listing = None # The push may be within the mtime resolution
+        new = s1.refresh()
+        self.assertEqual([n.hash for n in new], [pushed.changeset])
+        self.assertEqual(s1.dag.leafs, new)
+
+    def testLocked(self):
+        session = self.session(self.lcat1)
+        util.lock_file(self.lcat1)
+        self.assertRaises(RuntimeError, session.pull)
+        self.assertTrue(session.status().locked)
+
+
+# The reports passed to stats_hook() by the Instrumentation tests
+HOOK_REPORTS = []
+
+def stats_hook(report):
+    HOOK_REPORTS.append(report)
+
+def failing_stats_hook(report):
+    raise ValueError("The stats hook failed")
+
+
+class Instrumentation(SessionFixture):
+
+    def testStatsFile(self):
+        stats_file = join(self.tmpdir, "stats.json")
+        for lcat in [self.lcat1, self.lcat1, self.lcat2]:
+            del HOOK_REPORTS[:]
+            lrcloud.main(["--config-file=None",
+                          "--local-catalog", lcat,
+                          "--cloud-catalog", self.ccat,
+                          "--diff-cmd", COPY_DIFF_CMD,
+                          "--patch-cmd", COPY_PATCH_CMD,
+                          "--lightroom-exec-debug", "I am %s"%basename(lcat),
+                          "--stats", stats_file,
+                          "--stats-hook", "%s:stats_hook"%__name__])
+        with open(stats_file) as f:
+            report = json.load(f)
+        self.assertEqual(HOOK_REPORTS, [report])
+        names = set(p['name'] for p in report['phases'])
+        for name in ["lock", "backup", "dag", "apply", "diff", "compress", "hash", "metadata"]:
+            self.assertIn(name, names)
+        # The last run pulled the two changesets of the first two runs
+        self.assertEqual(report['totals']['apply']['count'], 2)
+        diff = [p for p in report['phases'] if p['name'] == "diff"][0]
+        self.assertGreater(diff['bytes_read'], 0)
+        self.assertGreater(diff['bytes_written'], 0)
+
+    def testSessionStats(self):
+        session = self.session(self.lcat1)
+        session.pull()
+        self.edit(self.lcat1, "I am #1\n")
+        session.push()
+        totals = session.stats.report()['totals']
+        self.assertEqual(totals['lock']['count'], 2)
+        self.assertEqual(totals['backup']['count'], 3)
+        self.assertEqual(totals['compress']['bytes_read'], os.path.getsize(self.lcat1))
+        self.assertEqual(totals['dag']['bytes_read'], os.path.getsize("%s.lrcloud"%self.ccat))
+
+    def testHookNotPersisted(self):
+        config = join(self.tmpdir, "lrcloud.ini")
+        argv = ["--config-file", config, "--local-catalog", self.lcat1,
+                "--cloud-catalog", self.ccat, "--lightroom-exec-debug", "I am #1"]
+        del HOOK_REPORTS[:]
+        lrcloud.main(argv + ["--stats-hook", "%s:stats_hook"%__name__])
+        lrcloud.main(argv)
+        self.assertEqual(len(HOOK_REPORTS), 1)
+        with open(config) as f:
+            self.assertNotIn("stats_hook", f.read())
+
+    def testFailingHook(self):
+        util.lock_file(self.lcat1)
+        with self.assertRaises(RuntimeError) as cm:
+            lrcloud.main(["--config-file=None",
+                          "--local-catalog", self.lcat1,
+                          "--cloud-catalog", self.ccat,
+                          "--lightroom-exec-debug", "I am #1",
+                          "--stats-hook", "%s:failing_stats_hook"%__name__])
+        self.assertIn("locked", str(cm.exception))
+
+
+class FakeClock(object):
+    """A simulated clock thus injected delays don't slow down the tests"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeCloud(SessionFixture):
+
+    def fake_cloud(self, **kwargs):
+        self.clock = FakeClock()
+        return FakeCloudFS(dirname(self.ccat), clock=self.clock.time,
+                           sleep=self.clock.sleep, **kwargs)
+
+    def testLatencyAndBandwidth(self):
+        session = self.session(self.lcat1)
+        session.pull()
+        self.edit(self.lcat1, "I am #1\n")
+        session.push()
+        with self.fake_cloud(latency=0.1, bandwidth=1000) as cloud:
+            self.session(self.lcat2).pull()
+        self.assertGreater(cloud.calls["listdir"], 0)
+        self.assertGreater(cloud.bytes_read, 0)
+        self.assertEqual(cloud.bytes_written, 0)
+        self.assertAlmostEqual(self.clock.now, 0.1*sum(cloud.calls.values())
+                                               + cloud.bytes_read/1000.0)
+        with open(self.lcat2) as f:
+            self.assertEqual(f.read(), "Init Lightroom Catalog\nI am #1\n")
+
+    def testEventualConsistency(self):
+        (s1, s2) = (self.session(self.lcat1), self.session(self.lcat2))
+        s1.pull()
+        s2.refresh()
+        with self.fake_cloud(visibility_delay=60):
+            self.edit(self.lcat1, "I am #1\n")
+            pushed = s1.push()
+            self.assertEqual(s2.refresh(), [])
+            self.assertEqual(s2.pull().applied, [])
+            self.clock.sleep(60)
+            self.assertEqual(s2.pull().applied, [pushed.changeset])
+
+    def testMetafileBeforeChangeset(self):
+        (s1, s2) = (self.session(self.lcat1), self.session(self.lcat2))
+        s1.pull()
+        s2.refresh()
+        with self.fake_cloud(visibility_delay=[("*.zip", 60)]):
+            self.edit(self.lcat1, "I am #1\n")
+            pushed = s1.push()
+            self.assertRaises(EnvironmentError, s2.pull)
+            self.assertFalse(isfile("%s.lock"%self.lcat2))
+            with open(self.lcat2) as f:
+                self.assertEqual(f.read(), "Init Lightroom Catalog\n")
+            self.clock.sleep(60)
+            self.assertEqual(s2.pull().applied, [pushed.changeset])
+
+    def testChildBeforeParent(self):
+        (s1, s2) = (self.session(self.lcat1), self.session(self.lcat2))
+        s1.pull()
+        s2.refresh()
+        with self.fake_cloud(visibility_delay=60) as cloud:
+            self.edit(self.lcat1, "I am #1\n")
+            parent = s1.push()
+            cloud.visibility_delay = 0
+            self.edit(self.lcat1, "I am #1 again\n")
+            child = s1.push()
+            # The child is deferred until its parent shows up
+            self.assertEqual(s2.refresh(), [])
+            self.assertEqual(s2.pull().applied, [])
+            self.assertNotIn(child.changeset, s2.dag.nodes)
+            self.clock.sleep(60)
+            self.assertEqual(s2.pull().applied, [parent.changeset, child.changeset])
+            self.assertEqual(len(s2.dag.nodes[parent.changeset].children), 1)
+            self.assertFalse(s2.dag.forked)
+        with open(self.lcat2) as f:
+            self.assertEqual(f.read(), "Init Lightroom Catalog\nI am #1\nI am #1 again\n")
+        # Nothing was rebased thus the cloud has the base and the two changesets
+        self.assertEqual(len(lrcloud.ChangesetDAG(self.ccat).nodes), 3)
+        self.assertEqual(MetaFile("%s.lrcloud"%self.lcat2)['conflicts'], {})
+
+    def testPartialWrite(self):
+        (s1, s2) = (self.session(self.lcat1), self.session(self.lcat2))
+        s1.pull()
+        self.edit(self.lcat1, "I am #1\n")
+        with self.fake_cloud() as cloud:
+            cloud.fail_next_writes(1)
+            self.assertRaises(InjectedFailure, s1.push)
+            self.assertFalse(isfile("%s.lock"%self.lcat1))
+            self.assertEqual(s2.pull().applied, [])
+            self.assertEqual(lrcloud.verify_changesets(None, self.ccat), [])
+            # Retrying overwrites the partially written changeset
+            pushed = s1.push()
+            self.assertEqual(s2.pull().applied, [pushed.changeset])
+            self.assertEqual(lrcloud.verify_changesets(None, self.ccat), [])
+
+
+class PageDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def testRoundTrip(self):
+        from . import pagediff
+        (old, new, patch, out) = [join(self.tmpdir, n) for n in ["old", "new", "patch", "out"]]
+        content = bytearray(os.urandom(5 * 4096 + 100))
+        with open(old, "wb") as f:
+            f.write(content)
+        for new_content in [content[:3 * 4096 + 7], content + b"more",
+                            content[:4096] + b"x" + content[4097:]]:
+            with open(new, "wb") as f:
+                f.write(new_content)
+            pagediff.diff(old, new, patch)
+            self.assertTrue(pagediff.is_patch(patch))
+            pagediff.patch(old, patch, out)
+            with open(out, "rb") as f:
+                self.assertEqual(f.read(), new_content)
+        # Only the changed page is in the last patch
+        with open(patch, "rb") as f:
+            self.assertEqual(list(pagediff.read_patch(f)[2]), [1])
+
+
+class Rebase(SessionFixture):
+    """Two machines that push from the same parent"""
+
+    def create_catalog(self, lcat):
+        with open(lcat, mode='wb') as f:
+            f.write(b"".join(bytes(bytearray([i]) * 4096) for i in range(3)))
+
+    def session(self, lcat):
+        return SyncSession(lcat, self.ccat)
+
+    def overwrite(self, lcat, offset, data):
+        with open(lcat, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+
+    def fork(self, offset1, offset2):
+        """Push from both catalogs without pulling in between"""
+        (s1, s2) = (self.session(self.lcat1), self.session(self.lcat2))
+        s1.pull()
+        s2.pull()
+        self.overwrite(self.lcat1, offset1, b"I am #1")
+        s1.push()
+        self.overwrite(self.lcat2, offset2, b"I am #2")
+        s2.push()
+        return (s1, s2)
+
+    def testMerge(self):
+        (s1, s2) = self.fork(10, 2 * 4096 + 10)
+        self.assertTrue(lrcloud.ChangesetDAG(self.ccat).forked)
+        s1.pull()
+        s2.pull()
+        dag = lrcloud.ChangesetDAG(self.ccat)
+        self.assertFalse(dag.forked)
+        self.assertEqual(len(dag.leafs), 2)
+        self.assertEqual(len(dag.nodes), 4)
+        self.assertIsNotNone(dag.leaf.merges)
+        with open(self.lcat1, "rb") as f1, open(self.lcat2, "rb") as f2:
+            content = f1.read()
+            self.assertEqual(content, f2.read())
+        self.assertEqual(content[10:17], b"I am #1")
+        self.assertEqual(content[2 * 4096 + 10:2 * 4096 + 17], b"I am #2")
+        self.assertEqual(len(content), 3 * 4096)
+        self.assertEqual(lrcloud.verify_changesets(None, self.ccat), [])
+
+        # Both machines continue on the merged leaf
+        self.overwrite(self.lcat2, 4096, b"I am #2 again")
+        pushed = s2.push()
+        self.assertEqual(s1.pull().applied, [pushed.changeset])
+        self.assertEqual(s1.status().behind, 0)
+
+    def conflict(self):
+        """Fork with changes to the same page. Returns the sessions of the
+           machine whose pull fails and of the other machine"""
+        (s1, s2) = self.fork(10, 20)
+        failed = []
+        for session in [s1, s2]:
+            try:
+                session.pull()
+            except RuntimeError:
+                failed.append(session)
+        self.assertEqual(len(failed), 1)
+        return (failed[0], s2 if failed[0] is s1 else s1)
+
+    def testConflict(self):
+        (loser, winner) = self.conflict()
+        self.assertTrue(lrcloud.ChangesetDAG(self.ccat).forked)
+        self.assertIsNone(loser.status().behind)
+
+    def testConflictIsRemembered(self):
+        (loser, winner) = self.conflict()
+        rebases = lambda session: session.stats.report()['totals']['rebase']['count']
+        counts = [rebases(loser), rebases(winner)]
+        self.assertRaises(RuntimeError, loser.pull)
+        winner.pull()
+        self.assertEqual([rebases(loser), rebases(winner)], counts)
+
+    def testResetToCloud(self):
+        (loser, winner) = self.conflict()
+        leaf = winner.pull().leaf
+        result = loser.pull(reset=True)
+        self.assertNotEqual(result.leaf, leaf)
+        with open(loser.local_catalog, "rb") as f1, open(winner.local_catalog, "rb") as f2:
+            content = f1.read()
+            self.assertEqual(content, f2.read())
+        self.assertNotIn(b"I am #%d"%(1 if loser.local_catalog == self.lcat1 else 2), content)
+        dag = lrcloud.ChangesetDAG(self.ccat)
+        self.assertFalse(dag.forked)
+        self.assertEqual(dag.leaf.hash, result.leaf)
+        self.assertEqual(lrcloud.verify_changesets(None, self.ccat), [])
+        self.assertEqual(winner.pull().applied, [result.leaf])
+        self.assertEqual(loser.status().behind, 0)
+        # Both machines continue on the leaf
+        self.overwrite(loser.local_catalog, 4096, b"I was reset")
+        pushed = loser.push()
+        self.assertEqual(winner.pull().applied, [pushed.changeset])
+
+
+    def testCollectRebasedBranch(self):
+        (s1, s2) = self.fork(10, 2 * 4096 + 10)
+        winner = lrcloud.ChangesetDAG(self.ccat).leaf.hash
+        if MetaFile("%s.lrcloud"%self.lcat1)['last_push']['hash'] != winner:
+            (s1, s2) = (s2, s1)
+        s1.pull()
+        loser = lrcloud.ChangesetDAG(self.ccat).leaf.merges
+        # The machine of the rebased branch still needs it
+        report = lrcloud.collect_garbage(self.ccat, 0)
+        self.assertEqual(report['changesets']['count'], 0)
+        s2.pull()
+        report = lrcloud.collect_garbage(self.ccat, 0)
+        self.assertEqual(report['changesets']['count'], 1)
+        self.assertEqual(report['metafiles']['count'], 1)
+        dag = lrcloud.ChangesetDAG(self.ccat)
+        self.assertNotIn(loser, dag.nodes)
+        self.assertFalse(dag.forked)
+        self.assertEqual(lrcloud.verify_changesets(None, self.ccat), [])
+        lcat3 = join(self.tmpdir, "local3.lrcat")
+        cmd_init_pull_from_cloud(lcat3, self.ccat)
+        with open(s1.local_catalog, "rb") as f1, open(lcat3, "rb") as f3:
+            self.assertEqual(f1.read(), f3.read())
+
+
+class MergeHeader(unittest.TestCase):
+
+    def page(self, **fields):
+        """A first page of a SQLite database with the 4-byte 'fields' set,
+           which are named by their offset, e.g. f36=0xFF"""
+        import struct
+        from . import pagediff
+        page = bytearray(pagediff.SQLITE_MAGIC + b"\0" * (4096 - len(pagediff.SQLITE_MAGIC)))
+        for (name, value) in fields.items():
+            offset = int(name[1:])
+            page[offset:offset + 4] = struct.pack(">I", value)
+        return bytes(page)
+
+    def testFields(self):
+        from .rebase import merge_header
+        base = self.page(f36=0xFF, f60=1)
+        merged = merge_header(0, base, self.page(f36=0x100, f60=1), self.page(f36=0xFF, f60=2))
+        self.assertEqual(merged, self.page(f36=0x100, f60=2))
+
+    def testConflictingField(self):
+        from .rebase import merge_header, RebaseConflict
+        # The branches change different bytes of the same field
+        (base, winner, loser) = [self.page(f36=v) for v in (0xFF, 0x100, 0x1FF)]
+        self.assertRaises(RebaseConflict, merge_header, 0, base, winner, loser)
+
+
+class RebaseSQLite(SessionFixture):
+
+    def create_catalog(self, lcat):
+        from . import benchmark
+        benchmark.create_catalog(lcat, 128 * 1024)
+
+    def update(self, lcat, image, rating):
+        import sqlite3
+        con = sqlite3.connect(lcat)
+        con.execute("UPDATE Adobe_images SET rating=? WHERE id_local=?", (rating, image))
+        con.commit()
+        con.close()
+
+    def testMerge(self):
+        import sqlite3
+        (s1, s2) = (SyncSession(self.lcat1, self.ccat), SyncSession(self.lcat2, self.ccat))
+        s1.pull()
+        s2.pull()
+        self.update(self.lcat1, 1, 42)
+        s1.push()
+        self.update(self.lcat2, 900, 43)
+        s2.push()
+        s2.pull()
+        s1.pull()
+        for lcat in [self.lcat1, self.lcat2]:
+            con = sqlite3.connect(lcat)
+            self.assertEqual(con.execute("PRAGMA integrity_check").fetchone(), ("ok",))
+            ratings = con.execute("SELECT rating FROM Adobe_images WHERE id_local IN (1, 900) "
+                                  "ORDER BY id_local").fetchall()
+            self.assertEqual(ratings, [(42,), (43,)])
+            con.close()
+
+
+class GarbageCollection(SessionFixture):
+
+    def testOrphans(self):
+        session = self.session(self.lcat1)
+        session.pull()
+        self.edit(self.lcat1, "I am #1\n")
+        session.push()
+        cloud_dir = dirname(self.ccat)
+        orphan = "%s_abcdef.zip"%self.ccat
+        with open(orphan, "w") as f:
+            f.write("An aborted push")
+        for name in ["old Smart Previews.lrdata", "cloud.zi Smart Previews.lrdata"]:
+            os.mkdir(join(cloud_dir, name))
+            with open(join(cloud_dir, name, "preview.dng"), "w") as f:
+                f.write("preview")
+
+        report = lrcloud.collect_garbage(self.ccat, 1)
+        self.assertEqual(report['changesets'], {'count': 0, 'bytes': 0, 'pending_bytes': 15})
+        lrcloud.main(["--config-file=None", "--cloud-catalog", self.ccat,
+                      "--gc", "--gc-dry-run", "--gc-grace", "0"])
+        self.assertTrue(isfile(orphan))
+
+        report = lrcloud.collect_garbage(self.ccat, 0)
+        self.assertEqual(report['changesets'], {'count': 1, 'bytes': 15, 'pending_bytes': 0})
+        self.assertEqual(report['smart_previews']['count'], 1)
+        self.assertEqual(report['metafiles']['count'], 0)
+        self.assertFalse(isfile(orphan))
+        self.assertFalse(os.path.isdir(join(cloud_dir, "old Smart Previews.lrdata")))
+        self.assertTrue(os.path.isdir(join(cloud_dir, "cloud.zi Smart Previews.lrdata")))
+        self.assertEqual(lrcloud.verify_changesets(None, self.ccat), [])
+
+    def testOneOffOptions(self):
+        config = join(self.tmpdir, "lrcloud.ini")
+        lrcloud.main(["--config-file", config, "--cloud-catalog", self.ccat,
+                      "--gc", "--gc-grace", "0"])
+        lrcloud.main(["--config-file", config, "--verify", "--jobs", "2"])
+        with open(config) as f:
+            content = f.read()
+        self.assertIn("cloud_catalog", content)
+        self.assertNotIn("gc_grace", content)
+        self.assertNotIn("jobs", content)
+
+    def testUnmanagedCatalog(self):
+        # A Lightroom catalog in the cloud folder that lrcloud doesn't sync
+        cloud_dir = dirname(self.ccat)
+        with open(join(cloud_dir, "Family.lrcat"), "w") as f:
+            f.write("Another Lightroom Catalog\n")
+        for name in ["Family Smart Previews.lrdata", "Family Previews.lrdata"]:
+            os.mkdir(join(cloud_dir, name))
+        report = lrcloud.collect_garbage(self.ccat, 0)
+        self.assertEqual(report['smart_previews']['count'], 0)
+        self.assertTrue(os.path.isdir(join(cloud_dir, "Family Smart Previews.lrdata")))
+
+
+class Benchmark(unittest.TestCase):
+
+    def testTinyRun(self):
+        from . import benchmark
+        report = benchmark.run(benchmark.parse_size("64K"), 0.1, [1, 2],
+                               ['copy'], ['zip', 'none'])
+        results = report['results']
+        self.assertEqual(len(results), 2 * (1 + 2*2))
+        for result in results:
+            self.assertGreater(result['catalog_bytes'], 64*1024 - 1)
+            self.assertGreaterEqual(result['seconds'], 0)
+        self.assertEqual(sorted(set(r['command'] for r in results)),
+                         ["init_pull_from_cloud", "init_push_to_cloud", "normal"])
+        json.loads(json.dumps(report))
+
+    def testEmptyChain(self):
+        from . import benchmark
+        self.assertRaises(ValueError, benchmark.run, 64*1024, 0.1, [0, 1], ['copy'], ['none'])
+        self.assertRaises(SystemExit, benchmark.main, ["--size", "64K", "--chain-lengths", "0"])
+
+
+class StartupTime(unittest.TestCase):
+    """Startup benchmark: importing the command line module must be cheap"""
+
+    # Modules that only some commands need thus they must be imported lazily
+    LAZY_MODULES = ['distutils', 'subprocess', 'tempfile', 'hashlib',
+                    'zipfile', 'shutil', 'json', 'pprint']
+
+    # The import time budget in milliseconds
+    BUDGET = float(os.environ.get("LRCLOUD_IMPORT_BUDGET_MS", 150))
+
+    def import_main(self):
+        code = "import sys; before = set(sys.modules); import lrcloud.__main__; "\
+               "print(' '.join(set(sys.modules) - before))"
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([dirname(dirname(abspath(__file__))),
+                                            env.get('PYTHONPATH', '')])
+        p = subprocess.Popen([sys.executable, "-X", "importtime", "-c", code], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+        (out, err) = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+        usec = 0
+        for line in err.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() in ['lrcloud', 'lrcloud.__main__']:
+                usec += int(fields[1].strip())
+        return (out.split(), usec / 1000.0)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "requires -X importtime")
+    def testLazyImports(self):
+        (modules, _) = self.import_main()
+        for name in self.LAZY_MODULES:
+            self.assertNotIn(name, modules)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "requires -X importtime")
+    def testImportTime(self):
+        # The best of a few runs to avoid noise from a busy machine
+        msec = min(self.import_main()[1] for _ in range(3))
+        self.assertLess(msec, self.BUDGET, "importing lrcloud takes %.1f ms, "\
+                        "the budget is %.1f ms"%(msec, self.BUDGET))
 
 
 def main():
@@ -4,72 +4,278 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import shutil
-import zipfile
-from zipfile import ZIP_DEFLATED
 from os.path import join, basename, dirname, isfile, abspath
-import tempfile
+from contextlib import contextmanager
 import logging
 import os
-import subprocess
+
+class LocalFS(object):
+    """The file operations used on catalogs, changesets and Smart Previews.
+
+    All such operations go through the module attribute 'fs', which tests
+    replace to emulate slow or unreliable cloud folders (see fakecloud.py)"""
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def open(self, path, mode='r'):
+        return open(path, mode)
+
+    def copy(self, src, dst):
+        """Copy the file 'src' to 'dst' including its modification time"""
+        import shutil
+        shutil.copy2(src, dst)
+
+    def makedirs(self, path):
+        os.makedirs(path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rmtree(self, path):
+        import shutil
+        shutil.rmtree(path, ignore_errors=True)
+
+fs = LocalFS()
+
+def lock_file(filename):
+    """Locks the file by writing a '.lock' file.
+       Returns True when the file is locked and
+       False when the file was locked already"""
+
+    lockfile = "%s.lock"%filename
+    if isfile(lockfile):
+        return False
+    else:
+        with open(lockfile, "w"):
+            pass
+    return True
+
+def unlock_file(filename):
+    """Unlocks the file by remove a '.lock' file.
+       Returns True when the file is unlocked and
+       False when the file was unlocked already"""
+
+    lockfile = "%s.lock"%filename
+    if isfile(lockfile):
+        os.remove(lockfile)
+        return True
+    else:
+        return False
+
+def copy_smart_previews(local_catalog, cloud_catalog, local2cloud=True):
+    """Copy Smart Previews from local to cloud or
+       vica versa when 'local2cloud==False'. Returns the number of bytes copied
+       NB: nothing happens if source dir doesn't exist"""
+
+    lcat_noext = local_catalog[0:local_catalog.rfind(".lrcat")]
+    ccat_noext = cloud_catalog[0:cloud_catalog.rfind(".lrcat")]
+    lsmart = join(dirname(local_catalog),"%s Smart Previews.lrdata"%basename(lcat_noext))
+    csmart = join(dirname(cloud_catalog),"%s Smart Previews.lrdata"%basename(ccat_noext))
+    if local2cloud and fs.isdir(lsmart):
+        logging.info("Copy Smart Previews - local to cloud: %s => %s"%(lsmart, csmart))
+        return copy_tree(lsmart, csmart)
+    elif fs.isdir(csmart):
+        logging.info("Copy Smart Previews - cloud to local: %s => %s"%(csmart, lsmart))
+        return copy_tree(csmart, lsmart)
+    return 0
+
+def hashsum(filename):
+    """Return a hash of the file From <http://stackoverflow.com/a/7829658>"""
+
+    import hashlib
+    from functools import partial
+    with fs.open(filename, mode='rb') as f:
+        d = hashlib.sha1()
+        for buf in iter(partial(f.read, 2**20), b''):
+            d.update(buf)
+    return d.hexdigest()
+
+# Seconds between the mtimes a file system can record. Some file systems,
+# such as FAT and HFS+, only have a resolution of one or two seconds
+MTIME_RESOLUTION = 2
+
+def catalog_state(filename):
+    """Return the size, mtime and SQLite file change counter of the local catalog
+       as the strings recorded in the 'catalog' section of its meta-file. They
+       tell cheaply whether the catalog changed. The counter is 'None' when the
+       catalog isn't a SQLite database. 'recorded' is the time of the call: an
+       edit within MTIME_RESOLUTION of it may keep the mtime (see same_mtime())"""
+
+    import struct
+    import time
+    from .pagediff import SQLITE_MAGIC
+
+    recorded = time.time()
+    st = os.stat(filename)
+    with open(filename, 'rb') as f:
+        header = f.read(28)
+    counter = None
+    if len(header) == 28 and header.startswith(SQLITE_MAGIC):
+        (counter,) = struct.unpack(">I", header[24:28])
+    return {'size': str(st.st_size), 'mtime': repr(st.st_mtime),
+            'change_counter': str(counter), 'recorded': repr(recorded)}
+
+def same_mtime(recorded, state):
+    """Return whether the catalog state 'state' has the mtime of the 'recorded'
+       state (see catalog_state()) and that mtime is older than the recording
+       by more than MTIME_RESOLUTION. Only then the equal mtime tells that the
+       catalog is unchanged since an edit right after the recording may have
+       kept it (the "racy" mtime)"""
+
+    if recorded.get('mtime') != state['mtime']:
+        return False
+    try:
+        return float(state['mtime']) < float(recorded.get('recorded')) - MTIME_RESOLUTION
+    except (TypeError, ValueError):
+        return False # Not recorded by older versions
 
 def copy(src, dst):
     """File copy that support compress and decompress of zip files"""
 
+    import shutil
+
     (szip, dzip) = (src.endswith(".zip"), dst.endswith(".zip"))
     logging.info("Copy: %s => %s"%(src, dst))
 
     if szip and dzip:#If both zipped, we can simply use copy
-        shutil.copy2(src, dst)
+        fs.copy(src, dst)
     elif szip:
-        with zipfile.ZipFile(src, mode='r') as z:
-            tmpdir = tempfile.mkdtemp()
-            try:
-                z.extractall(tmpdir)
-                if len(z.namelist()) != 1:
-                    raise RuntimeError("The zip file '%s' should only have one "\
-                                       "compressed file"%src)
-                tmpfile = join(tmpdir,z.namelist()[0])
-                try:
-                    os.remove(dst)
-                except OSError:
-                    pass
-                shutil.move(tmpfile, dst)
-            finally:
-                shutil.rmtree(tmpdir, ignore_errors=True)
+        import zipfile
+        with fs.open(src, mode='rb') as f, zipfile.ZipFile(f, mode='r') as z:
+            if len(z.namelist()) != 1:
+                raise RuntimeError("The zip file '%s' should only have one "\
+                                   "compressed file"%src)
+            with z.open(z.namelist()[0]) as zf, fs.open(dst, mode='wb') as df:
+                shutil.copyfileobj(zf, df, 2**20)
     elif dzip:
-        with zipfile.ZipFile(dst, mode='w', compression=ZIP_DEFLATED) as z:
+        import zipfile
+        with fs.open(dst, mode='wb') as f,\
+             zipfile.ZipFile(f, mode='w', compression=zipfile.ZIP_DEFLATED) as z:
             z.write(src, arcname=basename(src))
     else:#None of them are zipped
-        shutil.copy2(src, dst)
+        fs.copy(src, dst)
+
+def copy_tree(src, dst):
+    """Recursive copy of the directory 'src' to 'dst' that only copies files
+       that are missing or older in 'dst' (like distutils' copy_tree(update=1)).
+       Returns the number of bytes copied"""
+
+    nbytes = 0
+    if not fs.isdir(dst):
+        fs.makedirs(dst)
+    for name in fs.listdir(src):
+        (s, d) = (join(src, name), join(dst, name))
+        if fs.isdir(s):
+            nbytes += copy_tree(s, d)
+            continue
+        sstat = fs.stat(s)
+        if not fs.isfile(d) or sstat.st_mtime > fs.stat(d).st_mtime:
+            fs.copy(s, d)
+            nbytes += sstat.st_size
+    return nbytes
+
+@contextmanager
+def open_content(filename):
+    """Open the file content for binary reading. Zip files are opened as their
+       single compressed file, which is streamed thus nothing is written to disk"""
+
+    if filename.endswith(".zip"):
+        import zipfile
+        with fs.open(filename, mode='rb') as zf, zipfile.ZipFile(zf, mode='r') as z:
+            if len(z.namelist()) != 1:
+                raise RuntimeError("The zip file '%s' should only have one "\
+                                   "compressed file"%filename)
+            with z.open(z.namelist()[0]) as f:
+                yield f
+    else:
+        with fs.open(filename, mode='rb') as f:
+            yield f
+
+def content_size(filename):
+    """Return the size of the file content (see open_content())"""
+
+    if filename.endswith(".zip"):
+        import zipfile
+        with fs.open(filename, mode='rb') as zf, zipfile.ZipFile(zf, mode='r') as z:
+            return z.infolist()[0].file_size
+    return fs.stat(filename).st_size
+
+def content_hashsum(filename):
+    """Return a hash of the file content (see open_content())"""
+
+    import hashlib
+    from functools import partial
+
+    d = hashlib.sha1()
+    with open_content(filename) as f:
+        for buf in iter(partial(f.read, 2**20), b''):
+            d.update(buf)
+    return d.hexdigest()
 
 def remove(path):
     """Remove file or dir if exist"""
+
     try:
-        if isfile(path):
-            os.remove(path)
+        if fs.isfile(path):
+            fs.remove(path)
         else:
-            shutil.rmtree(path, ignore_errors=True)
+            fs.rmtree(path)
     except OSError:
         pass
 
-def apply_changesets(args, changesets, catalog):
-    """Apply to the 'catalog' the changesets in the metafile list 'changesets'"""
+def apply_changesets(args, changesets, catalog, stats=None):
+    """Apply to the 'catalog' the changesets in the metafile list 'changesets'.
+       Page-level changesets are applied in place by the builtin patch (see
+       pagediff.py) and the others by 'args.patch_cmd'.
+       The application of each changeset is recorded in 'stats' (if not None)"""
+
+    import shutil
+    import subprocess
+    import tempfile
+    from . import pagediff
+
+    if stats is None:
+        from .stats import Stats
+        stats = Stats()
 
     tmpdir = tempfile.mkdtemp()
     tmp_patch = join(tmpdir, "tmp.patch")
     tmp_lcat  = join(tmpdir, "tmp.lcat")
 
-    for node in changesets:
-        remove(tmp_patch)
-        copy(node.mfile['changeset']['filename'], tmp_patch)
-        logging.info("mv %s %s"%(catalog, tmp_lcat))
-        shutil.move(catalog, tmp_lcat)
-
-        cmd = args.patch_cmd.replace("$in1", tmp_lcat)\
-                            .replace("$patch", tmp_patch)\
-                            .replace("$out", catalog)
-        logging.info("Patch: %s"%cmd)
-        subprocess.check_call(cmd, shell=True)
+    try:
+        for node in changesets:
+            with stats.phase("apply", changeset=node.hash) as phase:
+                remove(tmp_patch)
+                copy(node.filename, tmp_patch)
+                if pagediff.is_patch(tmp_patch):
+                    logging.info("Patch (page-level): %s"%node.filename)
+                    pagediff.patch_inplace(catalog, tmp_patch)
+                    # Only the pages in the patch are written
+                    phase.read(node.filename)
+                    phase.wrote(tmp_patch)
+                    continue
+                if args.patch_cmd is None:
+                    raise RuntimeError("The changeset %s is not a page-level patch, "\
+                                       "use --patch-cmd"%node.filename)
+                logging.info("mv %s %s"%(catalog, tmp_lcat))
+                shutil.move(catalog, tmp_lcat)
 
-    shutil.rmtree(tmpdir, ignore_errors=True)
+                cmd = args.patch_cmd.replace("$in1", tmp_lcat)\
+                                    .replace("$patch", tmp_patch)\
+                                    .replace("$out", catalog)
+                logging.info("Patch: %s"%cmd)
+                subprocess.check_call(cmd, shell=True)
+                phase.read(node.filename, tmp_lcat)
+                phase.wrote(catalog)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)